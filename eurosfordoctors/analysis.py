@@ -0,0 +1,213 @@
+import json
+import os
+
+import pandas as pd
+
+from .pipeline import file_fingerprint
+from .schema import read_parquet, restore, to_parquet
+from .utils import MONEY_FIELDS_ONLY
+
+
+ENTITY_KEYS = ['company', 'type', 'uid']
+CELL_KEYS = ['company', 'type', 'label', 'uid']
+NAME_FIELDS = ['name', 'address', 'location']
+CUBE_FRAMES = ('cells', 'records', 'names', 'aggregated', 'companies')
+SOURCE = 'source.json'
+
+
+def load_aggregated(filename):
+    return pd.read_csv(filename).rename(columns={'slug': 'company'})
+
+
+def load_companies(filename):
+    # Research and development spending per company
+    df = pd.read_csv(filename)
+    df = df[df['amount_rd'].notnull()]
+    df = df.rename(columns={'amount_rd': 'amount', 'slug': 'company'})[['company', 'amount']]
+    df['amount'] = pd.to_numeric(df['amount'])
+    return df
+
+
+def _keys(df, columns):
+    return {c: df[c].astype(object).values for c in columns}
+
+
+def make_cells(df):
+    # Count and sum of the non-zero amounts per company, type, label and uid
+    amounts = df[MONEY_FIELDS_ONLY].astype(float).reset_index(drop=True)
+    stacked = amounts.where(amounts != 0).stack().dropna()
+    rows = stacked.index.get_level_values(0)
+    keys = {c: values[rows] for c, values in _keys(df, ['company', 'type', 'uid']).items()}
+    keys['label'] = stacked.index.get_level_values(1).values
+    cells = pd.DataFrame(keys)
+    cells['amount'] = stacked.values
+    cells = cells.groupby(CELL_KEYS, dropna=False, sort=True)['amount'].agg(['size', 'sum']).reset_index()
+    return cells.rename(columns={'size': 'count', 'sum': 'amount'})
+
+
+def make_records(df):
+    # Rows and computed totals per company, type and uid, rows without amounts included
+    amounts = df[MONEY_FIELDS_ONLY].astype(float)
+    records = pd.DataFrame(_keys(df, ENTITY_KEYS))
+    records['total'] = amounts.where(amounts != 0).sum(axis=1).values
+    records = records.groupby(ENTITY_KEYS, dropna=False, sort=True)['total'].agg(['size', 'sum']).reset_index()
+    return records.rename(columns={'size': 'rows', 'sum': 'total'})
+
+
+def make_names(df):
+    columns = ['uid'] + [c for c in NAME_FIELDS if c in df]
+    return df.loc[df['uid'].notnull(), columns].drop_duplicates('uid').set_index('uid')
+
+
+class Cube(object):
+    def __init__(self, cells, records, names, aggregated=None, companies=None):
+        self.cells = cells
+        self.records = records
+        self.names = names
+        self.aggregated = aggregated if aggregated is not None else pd.DataFrame(
+            columns=['company', 'type', 'count', 'amount'])
+        self.companies = companies if companies is not None else pd.DataFrame(columns=['company', 'amount'])
+
+    @classmethod
+    def build(cls, df, aggregated=None, companies=None):
+        return cls(make_cells(df), make_records(df), make_names(df), aggregated=aggregated, companies=companies)
+
+    def save(self, dirname):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        for name in CUBE_FRAMES:
+            frame = getattr(self, name)
+            to_parquet(frame.reset_index() if name == 'names' else frame, os.path.join(dirname, '%s.parquet' % name))
+
+    @classmethod
+    def load(cls, dirname):
+        frames = {name: pd.read_parquet(os.path.join(dirname, '%s.parquet' % name)) for name in CUBE_FRAMES}
+        frames['names'] = frames['names'].set_index('uid')
+        return cls(**frames)
+
+    def _records(self, type, named=True):
+        records = self.records[self.records['type'] == type]
+        if named:
+            records = records[records['uid'].notnull()]
+        return records
+
+    def _aggregated(self, type):
+        return self.aggregated[self.aggregated['type'] == type]
+
+    def named_count(self, type):
+        return self._records(type)['uid'].nunique()
+
+    def labels_per_entity(self, type):
+        # Number of non-zero amounts per company and uid
+        records = self._records(type).set_index(['company', 'uid'])
+        cells = self.cells[(self.cells['type'] == type) & self.cells['uid'].notnull()]
+        counts = cells.groupby(['company', 'uid'])['count'].sum()
+        return counts.reindex(records.index, fill_value=0)
+
+    def mean_labels(self, type):
+        return self.labels_per_entity(type).groupby(level='company').mean()
+
+    def estimated_aggregated(self, type):
+        # Aggregated payments per company divided by the named entities' labels per entity
+        mean_labels = self.mean_labels(type)
+        counts = self._aggregated(type).groupby('company')['count'].sum()
+        estimate = pd.merge(mean_labels.rename('mean_labels').to_frame(), counts.to_frame(), how='outer',
+                            left_index=True, right_index=True)
+        estimate['mean_labels'] = estimate['mean_labels'].fillna(mean_labels.mean())
+        estimate['estimate'] = estimate['count'] / estimate['mean_labels']
+        return estimate
+
+    def rows_per_entity(self, type):
+        return self._records(type).groupby('uid')['rows'].sum()
+
+    def estimated_total(self, type, rows_per_entity=None):
+        if rows_per_entity is None:
+            rows_per_entity = self.rows_per_entity(type).mean()
+        aggregated = round(self.estimated_aggregated(type)['estimate'].sum() / rows_per_entity)
+        return aggregated + self.named_count(type)
+
+    def named_amount(self, type):
+        return self._records(type, named=False)['total'].sum()
+
+    def aggregated_amount(self, type):
+        return self._aggregated(type)['amount'].sum()
+
+    def shares(self, type, rows_per_entity=None):
+        named_count = self.named_count(type)
+        total_count = self.estimated_total(type, rows_per_entity=rows_per_entity)
+        named_amount = self.named_amount(type)
+        aggregated_amount = self.aggregated_amount(type)
+        return pd.Series({
+            'named_count': named_count,
+            'estimated_count': total_count,
+            'named_count_percent': named_count / float(total_count) * 100,
+            'named_amount': named_amount,
+            'aggregated_amount': aggregated_amount,
+            'named_amount_percent': named_amount / (named_amount + aggregated_amount) * 100,
+            'named_average': named_amount / named_count,
+            'aggregated_average': aggregated_amount / float(total_count - named_count),
+        })
+
+    def amount_by_type(self):
+        named = self.records.groupby('type')['total'].sum()
+        aggregated = self.aggregated.groupby('type')['amount'].sum()
+        return pd.DataFrame({'named': named, 'aggregated': aggregated, 'total': named + aggregated})
+
+    def top(self, type, n=10, label=None):
+        if label is None:
+            totals = self._records(type).groupby('uid')['total'].sum()
+        else:
+            cells = self.cells[(self.cells['type'] == type) & (self.cells['label'] == label)]
+            totals = cells[cells['uid'].notnull()].groupby('uid')['amount'].sum()
+        top = totals.sort_values(ascending=False, kind='stable').head(n).rename('amount').to_frame()
+        return top.join(self.names)
+
+    def company_totals(self, type=None, research=False):
+        records = self.records if type is None else self.records[self.records['type'] == type]
+        aggregated = self.aggregated if type is None else self._aggregated(type)
+        totals = records.groupby('company')['total'].sum()
+        totals = totals.add(aggregated.groupby('company')['amount'].sum(), fill_value=0)
+        if research:
+            totals = totals.add(self.companies.groupby('company')['amount'].sum(), fill_value=0)
+        totals = totals.sort_values(ascending=False).rename('amount').to_frame()
+        totals['rank'] = totals['amount'].rank(ascending=False)
+        return totals
+
+    def publication(self, type='hcp'):
+        # Named share of the estimated entities per company
+        published = self._records(type).groupby('company')['rows'].sum()
+        estimate = self.estimated_aggregated(type)['estimate']
+        total = published + estimate
+        amounts = self.company_totals(type)['amount']
+        rates = pd.DataFrame({
+            'percent': published / total * 100,
+            'published': published,
+            'estimate_unpublished': estimate,
+            'estimated_count': total,
+            'average_amount': amounts / total,
+        })
+        return rates.sort_values('percent')
+
+    def company_breakdown(self, uid):
+        records = self.records[self.records['uid'] == uid]
+        return records.groupby('company')['total'].sum()
+
+
+def cached_cube(filename, aggregated=None, companies=None, dirname=None):
+    # Cube of an intermediate Parquet file, rebuilt when the file changes
+    dirname = dirname or '%s_cube' % os.path.splitext(filename)[0]
+    source = {'fingerprint': file_fingerprint(filename),
+              'aggregated': file_fingerprint(aggregated) if aggregated else None,
+              'companies': file_fingerprint(companies) if companies else None}
+    source_filename = os.path.join(dirname, SOURCE)
+    if os.path.exists(source_filename):
+        with open(source_filename) as f:
+            if json.load(f) == source:
+                return Cube.load(dirname)
+    df = restore(read_parquet(filename))
+    cube = Cube.build(df, aggregated=load_aggregated(aggregated) if aggregated else None,
+                      companies=load_companies(companies) if companies else None)
+    cube.save(dirname)
+    with open(source_filename, 'w') as f:
+        json.dump(source, f)
+    return cube
@@ -0,0 +1,230 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from . import geocode, synthetic
+from .pipeline import STAGES, Pipeline, make_settings
+
+
+logger = logging.getLogger(__name__)
+
+SIZES = {'10k': 10000, '100k': 100000, '1m': 1000000}
+SETTINGS = {
+    'no_postcode': ['abbvie', 'bayer'],
+    'no_pdf': ['bayer'],
+    'address_rules': {'abbvie': 'address_location_country_comma'},
+}
+# The stages the numbers are reported for, in pipeline order
+BENCH_STAGES = ('read_csv', 'make_money', 'fix_name', 'split_name', 'fix_address', 'candidate_pairs',
+                'compare_pairs', 'link_pairs', 'geocode_df', 'fill_postcodes', 'link_geocoded',
+                'payments', 'make_entities', 'make_slugs', 'clean', 'dedupe', 'geocode', 'entities')
+BASELINE_DIR = 'benchmarks'
+# A stage is slower than its baseline when it takes TOLERANCE longer and at least MIN_SECONDS more
+TOLERANCE = 0.25
+MIN_SECONDS = 0.5
+# Precision and recall may drop by this much before it counts as a regression
+QUALITY_TOLERANCE = 0.005
+
+
+def parse_size(value):
+    try:
+        return SIZES.get(value.lower()) or int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('size is a number of rows or one of %s' % ', '.join(SIZES))
+
+
+def pair_count(sizes):
+    sizes = np.asarray(sizes, dtype=np.int64)
+    return int((sizes * (sizes - 1) // 2).sum())
+
+
+def pairwise_scores(truth, predicted):
+    # Precision and recall over all pairs of rows placed in the same entity
+    df = pd.DataFrame({'truth': np.asarray(truth), 'predicted': np.asarray(predicted, dtype=object)})
+    true_pairs = pair_count(df.groupby('truth').size())
+    found_pairs = pair_count(df.groupby('predicted').size())
+    correct = pair_count(df.groupby(['truth', 'predicted']).size())
+    precision = correct / float(found_pairs) if found_pairs else 1.0
+    recall = correct / float(true_pairs) if true_pairs else 1.0
+    return collections.OrderedDict([
+        ('entities', int(df['truth'].nunique())),
+        ('found_entities', int(df['predicted'].nunique())),
+        ('true_pairs', true_pairs),
+        ('found_pairs', found_pairs),
+        ('precision', precision),
+        ('recall', recall),
+        ('f1', 2 * precision * recall / (precision + recall) if precision + recall else 0.0),
+    ])
+
+
+def truth_entities(df, truth):
+    # Rows of each company keep their raw file order through cleaning
+    rows = pd.DataFrame({'company': df['company'].astype(str).values,
+                         'row': df.groupby('company').cumcount().values})
+    merged = rows.merge(truth, on=['company', 'row'], how='left')
+    if merged['entity'].isnull().any():
+        raise ValueError('%d rows without a truth entity' % merged['entity'].isnull().sum())
+    return merged['entity'].values
+
+
+def quality(df, truth):
+    entities = truth_entities(df, truth)
+    result = collections.OrderedDict()
+    # uid_original holds the uids of the name and address pass, before the geocoded pass
+    result['dedupe'] = pairwise_scores(entities, df['uid_original'].fillna('').values)
+    result['geocode'] = pairwise_scores(entities, df['uid'].fillna('').values)
+    return result
+
+
+def prepare_data(dirname, rows, seed, duplicate_rate, noise):
+    # Data for the same parameters is generated once and reused
+    params = {'rows': rows, 'seed': seed, 'duplicate_rate': duplicate_rate, 'noise': noise}
+    params_file = os.path.join(dirname, 'params.json')
+    if os.path.exists(params_file):
+        with open(params_file) as f:
+            if json.load(f) == params:
+                return os.path.join(dirname, 'raw_csv'), synthetic.read_truth(dirname)
+    shutil.rmtree(dirname, ignore_errors=True)
+    start = time.time()
+    raw_dir, truth = synthetic.write_dataset(dirname, rows, seed=seed, duplicate_rate=duplicate_rate,
+                                             noise=noise)
+    logger.info('generated %d rows in %.1fs', len(truth), time.time() - start)
+    with open(params_file, 'w') as f:
+        json.dump(params, f)
+    return raw_dir, truth
+
+
+def run(workdir, rows, seed=synthetic.DEFAULT_SEED, duplicate_rate=synthetic.DUPLICATE_RATE,
+        noise=synthetic.NOISE, jobs=1, latency=0.0, profile=False):
+    data_dir = os.path.join(workdir, 'data_%d_%d' % (rows, seed))
+    raw_dir, truth = prepare_data(data_dir, rows, seed, duplicate_rate, noise)
+
+    # Every run starts cold, without cleaned files, uids or geocodes from the last one
+    cache_dir = os.path.join(workdir, 'cache')
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir)
+    geocode.use_cache(os.path.join(cache_dir, 'geocoding.db'))
+    pipeline = Pipeline(raw_dir, cache_dir, make_settings({'settings': SETTINGS}), jobs=jobs,
+                        provider=synthetic.StubProvider(latency=latency), rate=0)
+    start = time.time()
+    metrics_file = os.path.join(workdir, 'metrics.json')
+    entities = pipeline.run(stages=STAGES, profile=profile, metrics_file=metrics_file)
+    duration = time.time() - start
+    with open(metrics_file) as f:
+        recorded = json.load(f)
+
+    geocoded = pd.read_parquet(pipeline.path('geocoded.parquet'))
+    stages = collections.OrderedDict()
+    for name in BENCH_STAGES:
+        if name in recorded['stages']:
+            stage = recorded['stages'][name]
+            stages[name] = {'seconds': round(stage['seconds'], 3), 'rows': stage['rows'],
+                            'rows_per_second': round(stage['rows_per_second'] or 0.0, 1)}
+    return collections.OrderedDict([
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('params', {'rows': rows, 'seed': seed, 'duplicate_rate': duplicate_rate, 'noise': noise,
+                    'jobs': jobs, 'latency': latency}),
+        ('rows', len(geocoded)),
+        ('seconds', round(duration, 3)),
+        ('peak_rss_mb', round(recorded['peak_rss_mb'] or 0.0, 1)),
+        ('entities', len(entities)),
+        ('quality', quality(geocoded, truth)),
+        ('stages', stages),
+    ])
+
+
+def compare(result, baseline, tolerance=TOLERANCE, min_seconds=MIN_SECONDS,
+            quality_tolerance=QUALITY_TOLERANCE):
+    # Regressions against a stored result, as readable lines
+    keys = ('rows', 'seed', 'duplicate_rate', 'noise')
+    if any(result['params'].get(k) != baseline['params'].get(k) for k in keys):
+        return ['baseline is for other data: %s' % {k: baseline['params'].get(k) for k in keys}]
+    problems = []
+    for name, scores in baseline['quality'].items():
+        for key in ('precision', 'recall'):
+            now, then = result['quality'][name][key], scores[key]
+            if now < then - quality_tolerance:
+                problems.append('%s %s dropped from %.4f to %.4f' % (name, key, then, now))
+    for name, stage in baseline['stages'].items():
+        if name not in result['stages']:
+            problems.append('%s did not run' % name)
+            continue
+        now, then = result['stages'][name]['seconds'], stage['seconds']
+        if now > then * (1 + tolerance) and now - then >= min_seconds:
+            problems.append('%s slower: %.2fs, baseline %.2fs (%+.0f%%)' % (name, now, then,
+                                                                          100 * (now / then - 1)))
+    return problems
+
+
+def log_result(result):
+    for name, scores in result['quality'].items():
+        logger.info('%-8s precision %.4f recall %.4f f1 %.4f, %d of %d entities', name, scores['precision'],
+                    scores['recall'], scores['f1'], scores['found_entities'], scores['entities'])
+    for name, stage in result['stages'].items():
+        logger.info('%-16s %9.2fs %12.0f rows/s', name, stage['seconds'], stage['rows_per_second'])
+    logger.info('%d rows in %.1fs, peak %.0f MB', result['rows'], result['seconds'], result['peak_rss_mb'])
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m eurosfordoctors.benchmark',
+                                     description='Run the pipeline on synthetic data and compare with a baseline.')
+    parser.add_argument('--size', type=parse_size, default=SIZES['10k'],
+                        help='rows over both companies, a number or one of %s (default: 10k)' % ', '.join(SIZES))
+    parser.add_argument('--seed', type=int, default=synthetic.DEFAULT_SEED)
+    parser.add_argument('--duplicate-rate', type=float, default=synthetic.DUPLICATE_RATE,
+                        help='share of entities paid by both companies (default: %s)' % synthetic.DUPLICATE_RATE)
+    parser.add_argument('--noise', type=float, default=synthetic.NOISE,
+                        help='rate of name and address noise per field (default: %s)' % synthetic.NOISE)
+    parser.add_argument('--workdir', default=os.path.join(BASELINE_DIR, 'work'),
+                        help='directory for the generated data and caches')
+    parser.add_argument('-j', '--jobs', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stub geocoder waits per request')
+    parser.add_argument('--baseline', help='baseline JSON (default: %s/baseline_<size>.json)' % BASELINE_DIR)
+    parser.add_argument('--save-baseline', action='store_true', help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='allowed slowdown per stage (default: %s)' % TOLERANCE)
+    parser.add_argument('--profile', action='store_true')
+    parser.add_argument('-o', '--output', help='JSON file for the result')
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    result = run(args.workdir, args.size, seed=args.seed, duplicate_rate=args.duplicate_rate, noise=args.noise,
+                 jobs=args.jobs, latency=args.latency, profile=args.profile)
+    log_result(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    baseline = args.baseline or os.path.join(BASELINE_DIR, 'baseline_%d.json' % args.size)
+    if args.save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        logger.info('saved baseline %s', baseline)
+        return 0
+    if not os.path.exists(baseline):
+        logger.info('no baseline at %s, store one with --save-baseline', baseline)
+        return 0
+    with open(baseline) as f:
+        problems = compare(result, json.load(f), tolerance=args.tolerance)
+    for problem in problems:
+        logger.warning(problem)
+    if not problems:
+        logger.info('no regressions against %s', baseline)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from slugify import slugify
+
+
+MAX_BLOCK_SIZE = 500
+MIN_TOKEN_LENGTH = 3
+UID_NAMESPACE = uuid.UUID('6b1f3c0e-8a3d-4c5e-9a51-2f1f0e9d7c11')
+
+SOUNDEX = dict(zip('bfpvcgjkqsxzdtlmnr', '111122222222334556'))
+
+
+def phonetic_key(val):
+    # Soundex on the transliterated value
+    val = val.replace('-', '')
+    if not val:
+        return None
+    code = [val[0]]
+    last = SOUNDEX.get(val[0])
+    for c in val[1:]:
+        digit = SOUNDEX.get(c)
+        if digit is not None and digit != last:
+            code.append(digit)
+        if c not in 'hw':
+            last = digit
+    return ''.join(code)[:4].ljust(4, '0')
+
+
+def _tokens(val):
+    return [t for t in val.split('-') if len(t) >= MIN_TOKEN_LENGTH and not t.isdigit()]
+
+
+def name_keys(slug):
+    return _tokens(slug)
+
+
+def last_name_keys(slug):
+    return [phonetic_key(t) for t in _tokens(slug)]
+
+
+def street_keys(slug):
+    tokens = [t for t in _tokens(slug) if t.isalpha()]
+    if not tokens:
+        return []
+    return ['-'.join(tokens)]
+
+
+def postcode_keys(val):
+    val = ''.join(c for c in val if c.isdigit())
+    if not val:
+        return []
+    return [val]
+
+
+BLOCK_KEYS = (
+    ('name', 'name', name_keys, True),
+    ('last_name', 'last_name', last_name_keys, True),
+    ('postcode', 'postcode', postcode_keys, False),
+    ('street', 'address', street_keys, True),
+)
+
+
+def _column_keys(series, func, slug):
+    values = series.dropna()
+    values = values[values.astype(str) != '']
+    cache = {}
+    positions, keys = [], []
+    for pos, val in zip(values.index, values):
+        if val not in cache:
+            cache[val] = func(slugify(str(val)) if slug else str(val))
+        for key in cache[val]:
+            positions.append(pos)
+            keys.append(key)
+    return positions, keys
+
+
+def block_index(df, keys=BLOCK_KEYS):
+    frames = []
+    types = df['type'].values
+    positional = pd.RangeIndex(len(df))
+    for kind, column, func, slug in keys:
+        if column not in df:
+            continue
+        series = pd.Series(df[column].values, index=positional)
+        positions, values = _column_keys(series, func, slug)
+        if not positions:
+            continue
+        frames.append(pd.DataFrame({
+            'pos': positions,
+            'key': ['%s:%s:%s' % (kind, types[p], v) for p, v in zip(positions, values)]
+        }))
+    if not frames:
+        return pd.DataFrame({'pos': [], 'key': []})
+    return pd.concat(frames, ignore_index=True).drop_duplicates()
+
+
+def candidate_pairs(df, keys=BLOCK_KEYS, max_block_size=MAX_BLOCK_SIZE, stats=None):
+    index = block_index(df, keys=keys)
+    sizes = index.groupby('key')['pos'].transform('size')
+    if stats is not None:
+        block_sizes = index.groupby('key').size()
+        stats['blocks'] = int((block_sizes > 1).sum())
+        stats['skipped_blocks'] = int((block_sizes > max_block_size).sum())
+    index = index[(sizes > 1) & (sizes <= max_block_size)]
+
+    pairs = index.merge(index, on='key')
+    pairs = pairs[pairs['pos_x'] < pairs['pos_y']]
+    companies = df['company'].values
+    pairs = pairs[companies[pairs['pos_x'].values] != companies[pairs['pos_y'].values]]
+    pairs = pairs[['pos_x', 'pos_y']].drop_duplicates().values.astype(np.int64)
+    return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+
+def pairs_touching(pairs, mask):
+    # Keep pairs with at least one side in mask, e.g. only new records
+    mask = np.asarray(mask, dtype=bool)
+    return pairs[mask[pairs[:, 0]] | mask[pairs[:, 1]]]
+
+
+def compare_pairs(df, pairs, cmp):
+    records = df.to_dict('records')
+    matched = [(i, j) for i, j in pairs if cmp(records[i], records[j])]
+    return np.array(matched, dtype=np.int64).reshape(-1, 2)
+
+
+class UnionFind(object):
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return
+        # Smallest position becomes the root so results do not depend on union order
+        if b < a:
+            a, b = b, a
+        self.parent[b] = a
+
+    def roots(self):
+        return [self.find(x) for x in range(len(self.parent))]
+
+
+def link_pairs(df, pairs, field='uid'):
+    uf = UnionFind(len(df))
+    if field in df:
+        uids = df[field].values
+        first = {}
+        for pos, uid in enumerate(uids):
+            if pd.isnull(uid):
+                continue
+            if uid in first:
+                uf.union(first[uid], pos)
+            else:
+                first[uid] = pos
+    else:
+        uids = [None] * len(df)
+    for i, j in pairs:
+        uf.union(int(i), int(j))
+
+    component_uid = {}
+    roots = uf.roots()
+    for pos, root in enumerate(roots):
+        if root not in component_uid and pd.notnull(uids[pos]):
+            component_uid[root] = uids[pos]
+    labels = df.index
+    new_uids = []
+    for root in roots:
+        if root not in component_uid:
+            component_uid[root] = uuid.uuid5(UID_NAMESPACE, str(labels[root])).hex
+        new_uids.append(component_uid[root])
+    df[field] = new_uids
+    return df
+
+
+def window_pair_count(sizes, window_size):
+    # Comparisons made by sorted neighbourhood passes over frames of the given sizes
+    total = 0
+    for n in sizes:
+        w = min(window_size - 1, max(n - 1, 0))
+        total += w * n - w * (w + 1) // 2
+    return total
+
+
+def pair_recall(df, pairs, field='uid'):
+    labels = pd.Series(df[field].values)
+    labels = labels[labels.notnull()]
+    groups = [g.index.values for _, g in labels.groupby(labels) if len(g) > 1]
+    candidates = set(map(tuple, pairs.tolist()))
+
+    true_pairs = found_pairs = found_groups = 0
+    for members in groups:
+        uf = UnionFind(len(members))
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                true_pairs += 1
+                pair = (min(members[a], members[b]), max(members[a], members[b]))
+                if pair in candidates:
+                    found_pairs += 1
+                    uf.union(a, b)
+        if len(set(uf.roots())) == 1:
+            found_groups += 1
+    return {
+        'true_pairs': true_pairs,
+        'pair_recall': found_pairs / float(true_pairs) if true_pairs else 1.0,
+        'groups': len(groups),
+        'group_recall': found_groups / float(len(groups)) if groups else 1.0,
+    }
+
+
+def report(df, pairs, window_size, field=None, stats=None):
+    hcp_count = int((df['type'] == 'hcp').sum())
+    # The notebook runs three passes over all rows and one over hcp rows only
+    window_pairs = window_pair_count([len(df), hcp_count, len(df), len(df)], window_size)
+    result = {
+        'rows': len(df),
+        'candidate_pairs': len(pairs),
+        'window_pairs': window_pairs,
+        'reduction': 1 - len(pairs) / float(window_pairs) if window_pairs else 0.0,
+    }
+    if stats:
+        result.update(stats)
+    if field is not None:
+        result.update(pair_recall(df, pairs, field=field))
+    return result
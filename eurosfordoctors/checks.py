@@ -1,9 +1,183 @@
+import re
+from collections import namedtuple
+
 import numpy as np
+import pandas as pd
 
+from .fixers import fix_money_series
 from .utils import MONEY_FIELDS_ONLY
 
 
+# German 12345 and Polish 12-345 style postcodes
+POSTCODE_LIKE = re.compile(r'\b(?:\d{2}-\d{3}|\d{4,5})\b')
+AGGREGATE_KEYS = ['company', 'year', 'type', 'label']
+
+Rule = namedtuple('Rule', 'name description func')
+
+
 def check_computed_total(df):
     df['computed_total'] = df[MONEY_FIELDS_ONLY].sum(1)
     view = ['company', 'index', 'name', 'address', 'total', 'total_dirty', 'computed_total'] + MONEY_FIELDS_ONLY
-    return df[~np.isclose(df['computed_total'], df['total'], atol=1) & df['total'].notnull() & df['total'] != 0.0][view]
+    view = [c for c in view if c in df]
+    return df[~np.isclose(df['computed_total'], df['total'], atol=1) & df['total'].notnull() &
+              (df['total'] != 0.0)][view]
+
+
+class Context(object):
+    # Values shared by rules, each computed once per run
+    def __init__(self, df):
+        self.df = df
+        self._cache = {}
+
+    def get(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = func(self.df)
+        return self._cache[name]
+
+    @property
+    def amounts(self):
+        return self.get('amounts', lambda df: df[[f for f in MONEY_FIELDS_ONLY if f in df]].astype(float))
+
+    @property
+    def raw_amounts(self):
+        def parse(df):
+            raw = {}
+            for f in MONEY_FIELDS_ONLY:
+                dirty = f + '_dirty'
+                if dirty in df:
+                    raw[f] = pd.to_numeric(fix_money_series(df[dirty]), errors='coerce')
+                elif f in df:
+                    raw[f] = df[f].astype(float)
+            return pd.DataFrame(raw, index=df.index)
+        return self.get('raw_amounts', parse)
+
+    def text(self, column):
+        def strings(df):
+            if column not in df:
+                return pd.Series('', index=df.index)
+            return df[column].astype(object).where(df[column].notnull(), '').astype(str)
+        return self.get('text:%s' % column, strings)
+
+
+def total_mismatch(ctx):
+    df = ctx.df
+    if 'total' not in df:
+        return np.zeros(len(df), dtype=bool)
+    computed = ctx.amounts.sum(axis=1)
+    total = df['total'].astype(float)
+    return (~np.isclose(computed, total, atol=1) & total.notnull() & (total != 0.0)).values
+
+
+def negative_amount(ctx):
+    return (ctx.raw_amounts < 0).any(axis=1).values
+
+
+def unparsed_amount(ctx):
+    df = ctx.df
+    mask = np.zeros(len(df), dtype=bool)
+    for f in ctx.raw_amounts.columns:
+        dirty = f + '_dirty'
+        if dirty in df:
+            mask |= (df[dirty].notnull() & ctx.raw_amounts[f].isnull()).values
+    return mask
+
+
+def no_amount(ctx):
+    return (~(ctx.amounts > 0).any(axis=1)).values
+
+
+def duplicate_amounts(ctx):
+    df = ctx.df
+    amounts = ctx.amounts
+    keys = [c for c in ('company', 'type', 'name', 'address', 'location') if c in df]
+    has_amount = (amounts > 0).any(axis=1)
+    frame = pd.concat([df[keys], amounts], axis=1)
+    return (frame.duplicated(keep='first') & has_amount).values
+
+
+def missing_name(ctx):
+    df = ctx.df
+    missing = ctx.text('name').str.strip() == ''
+    if 'last_name' in df:
+        missing |= (df['type'] == 'hcp') & (ctx.text('last_name').str.strip() == '')
+    return missing.values
+
+
+def unparsed_postcode(ctx):
+    df = ctx.df
+    postcode = ctx.text('postcode')
+    in_text = ctx.text('address').str.contains(POSTCODE_LIKE) | ctx.text('location').str.contains(POSTCODE_LIKE)
+    malformed = (postcode != '') & ~postcode.str.fullmatch(POSTCODE_LIKE)
+    return (((postcode == '') & in_text) | malformed).values
+
+
+RULES = [
+    Rule('total_mismatch', 'total differs from the sum of the amounts', total_mismatch),
+    Rule('negative_amount', 'an amount is negative', negative_amount),
+    Rule('unparsed_amount', 'an amount could not be parsed', unparsed_amount),
+    Rule('no_amount', 'no positive amount', no_amount),
+    Rule('duplicate_amounts', 'same recipient and amounts as an earlier row of the company', duplicate_amounts),
+    Rule('missing_name', 'name or hcp last name is empty', missing_name),
+    Rule('unparsed_postcode', 'postcode left in the address or not a postcode', unparsed_postcode),
+]
+
+
+def count_payments(df):
+    # Payment counts per company/year/type/label without melting the frame
+    keys = [k for k in AGGREGATE_KEYS if k != 'label' and k in df]
+    paid = (df[[f for f in MONEY_FIELDS_ONLY if f in df]] > 0).astype(np.int64)
+    counted = paid.groupby([df[k] for k in keys], observed=True).sum()
+    counted = counted.stack().rename('individual_count').reset_index()
+    counted = counted.rename(columns={counted.columns[len(keys)]: 'label'})
+    return counted[counted['individual_count'] > 0]
+
+
+def reconcile(df, aggregated, atol=0.5):
+    keys = [k for k in AGGREGATE_KEYS if k in aggregated and (k == 'label' or k in df)]
+    counted = count_payments(df)
+    merged = aggregated.merge(counted, on=keys, how='left')
+    merged['total_count'] = merged['count'] + merged['individual_count']
+    merged['should_ind_count'] = merged['count'] / (merged['percent'] / 100) * ((100 - merged['percent']) / 100)
+    merged['diff_count'] = merged['should_ind_count'] - merged['individual_count']
+    merged['calc_percent'] = merged['count'] / merged['total_count'] * 100
+    merged['ok'] = np.isclose(merged['percent'], merged['calc_percent'], atol=atol) | ~(merged['total_count'] > 0)
+    return merged
+
+
+class CheckReport(object):
+    def __init__(self, df, rules, flags, reconciliation=None):
+        self.df = df
+        self.rules = rules
+        self.flags = flags
+        self.reconciliation = reconciliation
+
+    @property
+    def summary(self):
+        counts = self.flags.sum()
+        return pd.DataFrame({
+            'rule': [r.name for r in self.rules],
+            'description': [r.description for r in self.rules],
+            'count': [int(counts[r.name]) for r in self.rules],
+            'share': [counts[r.name] / float(len(self.flags)) if len(self.flags) else 0.0 for r in self.rules],
+        })
+
+    @property
+    def by_company(self):
+        return self.flags.groupby(self.df['company'].values).sum()
+
+    def rows(self, rule):
+        return self.df[self.flags[rule].values]
+
+    def failed_aggregates(self):
+        if self.reconciliation is None:
+            return None
+        return self.reconciliation[~self.reconciliation['ok']]
+
+
+def run_checks(df, rules=RULES, aggregated=None):
+    ctx = Context(df)
+    # One boolean column per rule, shared intermediate values are computed once
+    flags = pd.DataFrame({rule.name: np.asarray(rule.func(ctx), dtype=bool) for rule in rules},
+                         index=df.index, columns=[r.name for r in rules])
+    reconciliation = reconcile(df, aggregated) if aggregated is not None else None
+    return CheckReport(df, rules, flags, reconciliation=reconciliation)
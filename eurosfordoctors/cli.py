@@ -0,0 +1,70 @@
+import argparse
+import logging
+import time
+
+# Heavy modules (geocoder, fuzzywuzzy) are only imported by the stages that need them
+from .pipeline import STAGES, Pipeline, load_config, to_parquet
+
+
+def parse_stages(value):
+    stages = [s.strip() for s in value.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown stage: %s' % ', '.join(sorted(unknown)))
+    if 'entities' in stages and 'dedupe' not in stages:
+        raise argparse.ArgumentTypeError('entities needs the dedupe stage')
+    return tuple(s for s in STAGES if s in stages or s == 'clean')
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog='python -m eurosfordoctors',
+                                     description='Clean, deduplicate, geocode and export payment data.')
+    parser.add_argument('config', help='country config file, e.g. config/pl.json')
+    parser.add_argument('--stages', type=parse_stages, default=STAGES,
+                        help='comma separated stages to run (default: %s)' % ','.join(STAGES))
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes for dedupe comparisons (default: all CPUs)')
+    parser.add_argument('--raw-dir', help='directory with raw company CSVs, overrides the config')
+    parser.add_argument('--cache-dir', help='directory for cached stage outputs, overrides the config')
+    parser.add_argument('--gazetteer', help='postcode and city centroids to geocode from before the provider, '
+                        'a CSV, a GeoNames .txt dump or a geocoding .db, overrides the config')
+    parser.add_argument('-o', '--output', help='CSV, Parquet or entity store .db file for the result, '
+                        'overrides the config')
+    parser.add_argument('--metrics', help='JSON file for stage timings (default: metrics.json in the cache dir)')
+    parser.add_argument('--profile', action='store_true',
+                        help='sample the slowest functions, use with --jobs 1 to include cleaning')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser
+
+
+def write_output(df, filename):
+    if filename.endswith('.parquet'):
+        to_parquet(df, filename)
+    elif filename.endswith(('.db', '.sqlite')):
+        from .store import write_store
+
+        write_store(df, filename)
+    else:
+        df.to_csv(filename, index=False, encoding='utf-8')
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s %(name)s %(message)s')
+
+    config = load_config(args.config)
+    pipeline = Pipeline(args.raw_dir or config['raw_dir'], args.cache_dir or config['cache_dir'],
+                        config['settings'], country=config['country'], year=config['year'],
+                        jobs=args.jobs, gazetteer=args.gazetteer or config['gazetteer'],
+                        geocode_level=config['geocode_level'])
+    start = time.time()
+    df = pipeline.run(stages=args.stages, profile=args.profile, metrics_file=args.metrics)
+    logging.getLogger(__name__).info('%s done: %d rows in %.1fs', ','.join(args.stages), len(df),
+                                     time.time() - start)
+
+    # The configured output is the entity export, partial runs need an explicit --output
+    output = args.output or (config['output'] if 'entities' in args.stages else None)
+    if output:
+        write_output(df, output)
+    return df
@@ -0,0 +1,385 @@
+import functools
+import re
+
+import numpy as np
+import pandas as pd
+
+from slugify import slugify
+
+from .fixers import (RE_NAME_FIXES, RE_REPLACEMENTS, MALE_GENDER, FEMALE_GENDER,
+                     LAST_NAME_CAPITALS, MULTI_SPACE, NAME_DASH_SPACE, ENDS_DASH, CLEAN_NAME,
+                     POSTCODE, POSTCODE_CITY, ADDRESS_CITY, NORMALIZE_STREET, PUNCTUATION,
+                     BAD_HOUSE_NUMBER, split_hco_name_value)
+from .names import get_titles
+from .rules import CompanyRules
+
+
+POSTCODE_GROUP = re.compile('(%s)' % POSTCODE.pattern)
+POSTCODE_CITY_MATCH = re.compile('^(?:%s)' % POSTCODE_CITY.pattern)
+ADDRESS_CITY_MATCH = re.compile('^(?:%s)' % ADDRESS_CITY.pattern)
+UMLAUTS = re.compile('[ßüäö]')
+
+
+def _unique_index(func):
+    @functools.wraps(func)
+    def inner(df, *args, **kwargs):
+        index = df.index
+        df = func(df.reset_index(drop=True), *args, **kwargs)
+        df.index = index
+        return df
+    return inner
+
+
+def _set(df, mask, column, values):
+    if column not in df:
+        df[column] = np.nan
+    if df[column].dtype != object:
+        df[column] = df[column].astype(object)
+    df.loc[mask, column] = np.asarray(values, dtype=object)
+
+
+def _strings(series):
+    return series.astype(object)
+
+
+def is_upper(series):
+    val = series.str.replace(UMLAUTS, '', regex=True)
+    return (val.str.upper() == val).values
+
+
+def pdf_space_fixer(series):
+    # Breaks more things than it fixes
+    return series
+    # return PDF_SPACE_FIXES.sub_series(series)
+
+
+def _on_unique(func):
+    # Locations and addresses repeat a lot, run the regexes once per distinct value.
+    # The number of rows per value goes to func as weights, fix table hits count rows.
+    @functools.wraps(func)
+    def inner(series, *args, **kwargs):
+        codes, uniques = pd.factorize(series)
+        if len(uniques) == len(series):
+            return func(series, *args, **kwargs)
+        weights = np.bincount(codes[codes >= 0], minlength=len(uniques))
+        fixed = func(pd.Series(uniques, dtype=object), *args, weights=weights, **kwargs).values
+        values = np.where(codes >= 0, fixed.take(codes), series.values)
+        return pd.Series(values, index=series.index, dtype=object)
+    return inner
+
+
+@_on_unique
+def apply_name_fixes(series, fixes=RE_NAME_FIXES, weights=None):
+    return fixes.sub_series(series, weights=weights)
+
+
+@_on_unique
+def replace_words(series, weights=None):
+    return RE_REPLACEMENTS.sub_series(series, weights=weights)
+
+
+def _title_upper(series, min_length=0):
+    upper = is_upper(series) & (series.str.len() > min_length).values
+    return series.where(~upper, series.str.title())
+
+
+def _fix_hcp_name(df, hcp, name, rules):
+
+    male = name.str.match(MALE_GENDER).values
+    female = name.str.match(FEMALE_GENDER).values
+    name[male] = name[male].str.replace(MALE_GENDER, '', regex=True).str.strip()
+    name[female] = name[female].str.replace(FEMALE_GENDER, '', regex=True).str.strip()
+    gender = pd.Series(np.where(female, 'Frau', np.where(male, 'Herr', None)), index=name.index)
+    if (male | female).any():
+        _set(df, _subset(hcp, male | female), 'gender', gender[male | female])
+
+    company = df.loc[hcp, 'company']
+    semicolon = rules.flag(company, 'semicolon_name_split')
+    name[semicolon] = name[semicolon].str.replace(';', ' ', regex=False)
+
+    comma_title = rules.flag(company, 'comma_split_title')
+    comma_title_name = rules.flag(company, 'comma_split_title_name')
+    comma_title_name = comma_title_name & ~comma_title
+    rest = ~comma_title & ~comma_title_name
+
+    title = pd.Series(None, index=name.index, dtype=object)
+    has_title = rest.copy()
+
+    split = comma_title & name.str.contains(',', regex=False).values
+    if split.any():
+        parts = name[split].str.split(',', n=1, expand=True)
+        name[split] = parts[0]
+        title[split] = parts[1]
+        has_title |= split
+
+    if comma_title_name.any():
+        parts = name[comma_title_name].str.split(',', n=2, expand=True)
+        if len(parts.columns) == 3:
+            three = parts[2].notnull()
+            parts = parts[three]
+            split = _subset(comma_title_name, three.values)
+            title[split] = parts[1]
+            name[split] = parts[0] + ', ' + parts[2]
+            has_title |= split
+
+    if rest.any():
+        titles = name[rest].map(get_titles)
+        title[rest] = [t for t, n in titles]
+        name[rest] = [n for t, n in titles]
+
+    if has_title.any():
+        _set(df, _subset(hcp, has_title), 'title', title[has_title])
+    return name
+
+
+def _subset(mask, submask):
+    mask = mask.copy()
+    mask[mask] = submask
+    return mask
+
+
+@_unique_index
+def fix_name(df, COMPANY_SETTINGS):
+    df = df.copy()
+    rules = CompanyRules(COMPANY_SETTINGS)
+    name = apply_name_fixes(_strings(df['name']))
+
+    hcp = (df['type'] == 'hcp').values
+    if hcp.any():
+        name[hcp] = _fix_hcp_name(df, hcp, name[hcp].copy(), rules)
+
+    _set(df, slice(None), 'name', _title_upper(name, min_length=4))
+    return df
+
+
+def _split_hco_name(df, hco, rules):
+    name = _strings(df.loc[hco, 'name'])
+    splits = name.map(split_hco_name_value)
+    success = splits.notnull().values
+    if success.any():
+        name[success] = [n for n, d in splits[success]]
+        _set(df, _subset(hco, success), 'recipient_detail', [d for n, d in splits[success]])
+
+    name = name.str.replace(ENDS_DASH, '', regex=True).str.strip()
+    pdf = ~rules.flag(df.loc[hco, 'company'], 'no_pdf')
+    name[pdf] = pdf_space_fixer(name[pdf])
+    _set(df, hco, 'name', replace_words(name))
+
+
+def _name_parts(name, company, rules):
+    bad_order = rules.flag(company, 'bad_name_order')
+    capitals = bad_order & rules.flag(company, 'last_name_capitals')
+    comma = name.str.contains(',', regex=False).values
+
+    parts = pd.Series(None, index=name.index, dtype=object)
+    parts[comma] = name[comma].str.split(',').str[::-1]
+
+    mask = ~comma & capitals
+    if mask.any():
+        matches = name[mask].str.extract(LAST_NAME_CAPITALS, expand=True)
+        missing = matches[0].isnull()
+        if missing.any():
+            print(name[mask][missing])
+            raise ValueError('%d names without capital last name' % missing.sum())
+        parts[mask] = pd.Series([list(x) for x in zip(matches[0], matches[1])],
+                                index=matches.index, dtype=object)
+
+    mask = ~comma & bad_order & ~capitals
+    parts[mask] = name[mask].str.split(' ', n=1)
+    mask = ~comma & ~bad_order
+    parts[mask] = name[mask].str.rsplit(' ', n=1)
+
+    parts[bad_order] = parts[bad_order].str[::-1]
+    return parts
+
+
+def _join_parts(parts):
+    length = parts.str.len().values
+    columns = []
+    for i in range(length.max()):
+        column = parts.str[i].str.replace(MULTI_SPACE, ' ', regex=True)
+        columns.append(_title_upper(column))
+
+    name = columns[0]
+    first = pd.Series('', index=parts.index, dtype=object)
+    last = columns[0].copy()
+    for i, column in enumerate(columns):
+        if i > 0:
+            present = i < length
+            name = name.where(~present, name + ' ' + column)
+            last[present] = column[present]
+        in_first = i < length - 1
+        first = first.where(~in_first, column if i == 0 else first + ' ' + column)
+    return name.str.strip(), first.str.strip(), last.str.strip()
+
+
+def _split_hcp_name(df, hcp, rules):
+    name = _strings(df.loc[hcp, 'name'])
+    company = df.loc[hcp, 'company']
+    parts = _name_parts(name, company, rules)
+    name, first_name, last_name = _join_parts(parts)
+
+    pdf = ~rules.flag(company, 'no_pdf')
+    columns = {}
+    for k, val in (('name', name), ('first_name', first_name), ('last_name', last_name)):
+        val = val.str.replace(NAME_DASH_SPACE, '', regex=True)
+        val[pdf] = pdf_space_fixer(val[pdf])
+        columns[k] = val
+
+    name = columns['name'].str.replace(MULTI_SPACE, ' ', regex=True)
+    clean_name = name.str.replace(CLEAN_NAME, '\\1 \\2', regex=True).str.lower()
+    slugs = {x: slugify(x) for x in clean_name.unique()}
+
+    _set(df, hcp, 'name', name)
+    _set(df, hcp, 'first_name', columns['first_name'])
+    _set(df, hcp, 'last_name', columns['last_name'])
+    _set(df, hcp, 'clean_name', clean_name.map(slugs))
+
+
+@_unique_index
+def split_name(df, COMPANY_SETTINGS):
+    df = df.copy()
+    rules = CompanyRules(COMPANY_SETTINGS)
+    hco = (df['type'] == 'hco').values
+    if hco.any():
+        _split_hco_name(df, hco, rules)
+
+    hcp = ~hco
+    if 'first_name' in df:
+        hcp &= ~df['first_name'].map(bool).values
+    if hcp.any():
+        _split_hcp_name(df, hcp, rules)
+    return df
+
+
+def _replace_postcodes(values, postcodes):
+    return [v.replace(p, '').strip() for v, p in zip(values, postcodes)]
+
+
+def extract_location(df, mask, rules):
+    location = _strings(df.loc[mask, 'location'])
+    company = df.loc[mask, 'company']
+    pdf = ~rules.flag(company, 'no_pdf')
+    location[pdf] = pdf_space_fixer(location[pdf])
+    location = _title_upper(location)
+
+    postcode = ~rules.flag(company, 'no_postcode')
+    if postcode.any():
+        found = location[postcode].str.extract(POSTCODE_GROUP, expand=False)
+        has_postcode = found.notnull().values
+        found = found[has_postcode]
+        postcode = _subset(postcode, has_postcode)
+        location[postcode] = _replace_postcodes(location[postcode], found)
+        if postcode.any():
+            _set(df, _subset(mask, postcode), 'postcode', found)
+
+    _set(df, mask, 'location', apply_name_fixes(location))
+
+
+def _company_in_address(df, mask):
+    address = df.loc[mask, 'address']
+    parts = address.str.rsplit(', ', n=2, expand=True)
+    if len(parts.columns) < 3:
+        return
+    three = parts[2].notnull().values
+    parts = parts[three]
+    mask = _subset(mask, three)
+    _set(df, mask, 'address', parts[1] + ', ' + parts[2])
+    detail = df.loc[mask, 'recipient_detail']
+    detail = [d + ', ' + p if pd.notnull(d) and d else p for d, p in zip(detail, parts[0])]
+    _set(df, mask, 'recipient_detail', detail)
+
+
+def _address_rules(df, mask, rules):
+    for rule, rule_mask in rules.address_rules(df['company']):
+        rule_mask = mask & rule_mask
+        if not rule_mask.any():
+            continue
+        for column, values in rule.apply(_strings(df.loc[rule_mask, 'address'])).items():
+            if len(values):
+                _set(df, df.index.isin(values.index), column, values.sort_index())
+
+
+def _address_postcode(df, mask):
+    address = _strings(df.loc[mask, 'address'])
+    matches = address.str.extract(POSTCODE_CITY_MATCH, expand=True)
+    city = matches[0].notnull().values
+    if city.any():
+        _set(df, _subset(mask, city), 'address', matches.loc[city, 0])
+        _set(df, _subset(mask, city), 'postcode', matches.loc[city, 1])
+
+    address = address[~city]
+    found = address.str.extract(POSTCODE_GROUP, expand=False)
+    has_postcode = found.notnull().values
+    if has_postcode.any():
+        mask = _subset(_subset(mask, ~city), has_postcode)
+        _set(df, mask, 'address', _replace_postcodes(address[has_postcode], found[has_postcode]))
+        _set(df, mask, 'postcode', found[has_postcode])
+
+
+def _address_city(df, mask):
+    matches = df.loc[mask, 'address'].str.extract(ADDRESS_CITY_MATCH, expand=True)
+    city = matches[0].notnull().values
+    if city.any():
+        mask = _subset(mask, city)
+        _set(df, mask, 'address', matches.loc[city, 0].str.strip())
+        _set(df, mask, 'location', matches.loc[city, 1].str.strip())
+
+
+def _fix_house_number(match):
+    return '%s%s-%s' % (match.group(1), int(match.group(2)), int(match.group(3)))
+
+
+def _house_numbers(address):
+    matches = address.str.extract(BAD_HOUSE_NUMBER, expand=True)
+    found = matches[1].notnull().values
+    if not found.any():
+        return address
+    n1 = matches.loc[found, 1].astype(int).values
+    n2 = matches.loc[found, 2].astype(int).values
+    bad = _subset(found, np.abs(n1 - n2) < 5)
+    address[bad] = address[bad].str.replace(BAD_HOUSE_NUMBER, _fix_house_number, regex=True)
+    return address
+
+
+@_unique_index
+def fix_address(df, COMPANY_SETTINGS):
+    df = df.copy()
+    rules = CompanyRules(COMPANY_SETTINGS)
+    has_location = df['location'].notnull().values
+    if has_location.any():
+        extract_location(df, has_location, rules)
+
+    has_address = df['address'].notnull().values
+    if has_address.any():
+        address = _title_upper(_strings(df.loc[has_address, 'address']))
+        pdf = ~rules.flag(df['company'], 'no_pdf')[has_address]
+        address[pdf] = pdf_space_fixer(address[pdf])
+        address = address.str.replace(NORMALIZE_STREET, '\\1tr.\\3', regex=True)
+        _set(df, has_address, 'address', address)
+
+        mask = has_address & rules.flag(df['company'], 'hcp_company_in_address')
+        if mask.any():
+            _company_in_address(df, mask)
+
+        _address_rules(df, has_address, rules)
+
+        mask = has_address & ~rules.flag(df['company'], 'no_postcode')
+        if mask.any():
+            _address_postcode(df, mask)
+
+        no_location = df['location'].isnull().values
+        if (has_address & no_location).any():
+            _address_city(df, has_address & no_location)
+        if (has_address & ~no_location).any():
+            extract_location(df, has_address & ~no_location, rules)
+
+        address = _strings(df.loc[has_address, 'address'])
+        address = address.str.replace(PUNCTUATION, '\\1', regex=True)
+        address = _house_numbers(apply_name_fixes(address))
+        _set(df, has_address, 'address', address)
+
+    has_location = df['location'].notnull().values
+    if has_location.any():
+        _set(df, has_location, 'location', apply_name_fixes(_strings(df.loc[has_location, 'location'])))
+    return df
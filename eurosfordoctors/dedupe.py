@@ -1,25 +1,32 @@
-import difflib
+import functools
 import math
 
+import numpy as np
 import pandas as pd
 
-from fuzzywuzzy import fuzz
+from .blocking import compare_pairs, link_pairs, pairs_touching
+from .gazetteer import CENTROIDS
+from .similarity import SIMILARITY
+from .spatial import neighbour_pairs
+
+MAX_DISTANCE_KM = 0.5
 
 
 def fuzzy_compare(a, b, threshold=0.9):
     if pd.isnull(a) or pd.isnull(b):
         return False
-    ratio = fuzz.token_set_ratio(a, b) / 100.0
-    sm = difflib.SequenceMatcher(None, a, b)
-    return sm.ratio() >= threshold or ratio >= threshold
+    return SIMILARITY.fuzzy(a, b, threshold)
 
 
 def one_contains_other(a, b):
     if pd.isnull(a) or pd.isnull(b):
         return False
-    a = a.lower()
-    b = b.lower()
-    return a in b or b in a
+    return SIMILARITY.contains(a, b)
+
+
+def similar(a, b, threshold=0.9):
+    # one_contains_other or fuzzy_compare, memoized per pair
+    return SIMILARITY.match(a, b, threshold)
 
 
 def compare_rows(a, b, geoident=False, normalize=None):
@@ -31,8 +38,8 @@ def compare_rows(a, b, geoident=False, normalize=None):
 
     if a['type'] == 'hcp':
         threshold = 0.9
-        name_match = one_contains_other(a['last_name'], b['last_name']) or fuzzy_compare(a['last_name'], b['last_name'], threshold=threshold)
-        name_match = name_match and (one_contains_other(a['first_name'], b['first_name']) or fuzzy_compare(a['first_name'], b['first_name'], threshold=threshold))
+        name_match = similar(a['last_name'], b['last_name'], threshold)
+        name_match = name_match and similar(a['first_name'], b['first_name'], threshold)
     else:
         threshold = 0.93
         an, bn = a['name'], b['name']
@@ -42,13 +49,13 @@ def compare_rows(a, b, geoident=False, normalize=None):
             bn += ' %s' % b['recipient_detail']
         if normalize is not None:
             an, bn = normalize(an), normalize(bn)
-        name_match = one_contains_other(an, bn) or fuzzy_compare(an, bn, threshold=threshold)
+        name_match = similar(an, bn, threshold)
 
     if not name_match:
         return False
 
-    address_match = one_contains_other(a['address'], b['address']) or fuzzy_compare(a['address'], b['address'])
-    location_match = one_contains_other(a['location'], b['location']) or fuzzy_compare(a['location'], b['location'])
+    address_match = similar(a['address'], b['address'], 0.9)
+    location_match = similar(a['location'], b['location'], 0.9)
     has_location = pd.notnull(a['location']) and pd.notnull(b['location']) and a['location'] and b['location']
 
     if address_match and (geoident or location_match or (not has_location and (a['type'] == 'hcp' and a['name'] == b['name']))):
@@ -57,6 +64,10 @@ def compare_rows(a, b, geoident=False, normalize=None):
     return False
 
 
+def compare_many(a, rows, **kwargs):
+    return [compare_rows(a, b, **kwargs) for b in rows]
+
+
 def get_distance_in_km(lat1, lng1, lat2, lng2):
     R = 6371
     DegToRadFactor = math.pi / 180
@@ -74,7 +85,25 @@ def compare_geocoded_rows(a, b, normalize=None):
     if pd.isnull(a['lat']):
         return False
     dist = get_distance_in_km(a['lat'], a['lng'], b['lat'], b['lng'])
-    if dist > 0.5:
+    if dist > MAX_DISTANCE_KM:
         return False
 
     return compare_rows(a, b, geoident=True, normalize=normalize)
+
+
+def located(df):
+    # Positions of rows with their own coordinates. Rows on a gazetteer centroid would pair with
+    # everyone on it, the name and address blocking pass already compared them.
+    if 'geo_precision' not in df:
+        return np.arange(len(df))
+    return np.nonzero(~df['geo_precision'].isin(CENTROIDS).values)[0]
+
+
+def link_geocoded(df, normalize=None, field='uid', new=None):
+    # Only compares rows within MAX_DISTANCE_KM of each other
+    positions = located(df)
+    pairs = positions[neighbour_pairs(df.iloc[positions], radius=MAX_DISTANCE_KM)]
+    if new is not None:
+        pairs = pairs_touching(pairs, new)
+    cmp = functools.partial(compare_rows, geoident=True, normalize=normalize)
+    return link_pairs(df, compare_pairs(df, pairs, cmp), field=field)
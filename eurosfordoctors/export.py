@@ -1,15 +1,18 @@
 import json
 import re
 
+import numpy as np
 import pandas as pd
-import pyprind
 from slugify import slugify
 
+from .metrics import Progress
+from .payments import LABEL_FIELDS, make_payments_table
 from .utils import AMOUNT_FIELDS
 
-LABEL_FIELDS = ['company', 'currency', 'type', 'year', 'recipient_detail']
 PAYMENT_FIELDS = LABEL_FIELDS + AMOUNT_FIELDS
 
+TEXT_FIELDS = ('location', 'address', 'name', 'first_name', 'last_name')
+
 NON_WORD = re.compile('\W')
 
 
@@ -29,7 +32,8 @@ def get_best_value(series):
         return series[lvi]
     if len(vc) == 1:
         return vc.idxmax()
-    if vc.name not in ('location', 'address', 'name', 'first_name', 'last_name'):
+    # value_counts names its result 'count' in newer pandas, check the column name
+    if series.name not in TEXT_FIELDS:
         return vc.idxmax()
     vc = vc.rank(method='dense', ascending=False)
     candidates = list(vc[vc == 1.0].index)
@@ -38,29 +42,71 @@ def get_best_value(series):
     return candidates[0][1]
 
 
-def make_entities(df):
+def entity_columns(df):
     columns = set(list(df.columns)) - {'uid'}
-    columns = columns - set(PAYMENT_FIELDS) | {'type'}
+    return columns - set(PAYMENT_FIELDS) | {'type'}
+
+
+def make_entities(df, nested=False):
+    columns = entity_columns(df)
 
     groups = df.groupby('uid')
-    progress_logger = pyprind.ProgPercent(len(groups))
+    progress = Progress(len(groups), label='entities')
 
     for index, rows in groups:
-        entity = {
-            k: get_best_value(rows[k]) for k in columns
-        }
+        entity = {'uid': index}
+        entity.update((k, get_best_value(rows[k])) for k in columns)
         melted_rows = pd.melt(rows[PAYMENT_FIELDS], id_vars=LABEL_FIELDS,
                               value_vars=AMOUNT_FIELDS, var_name='label', value_name='amount')
-        entity['payments'] = json.dumps([row.to_dict() for i, row in melted_rows.iterrows()
-                                             if pd.notnull(row['amount']) and row['amount'] > 0])
+        payments = [row.to_dict() for i, row in melted_rows.iterrows()
+                    if pd.notnull(row['amount']) and row['amount'] > 0]
+        entity['payments'] = payments if nested else json.dumps(payments)
         yield entity
-        progress_logger.update()
+        progress.update()
+    progress.done()
 
 
 def make_entities_df(df):
     return pd.DataFrame(make_entities(df), dtype="object")
 
 
+def best_values(uids, series):
+    valid = series.notnull().values
+    values = pd.DataFrame({'uid': uids[valid], 'val': series.values[valid],
+                           'pos': np.nonzero(valid)[0]})
+    counts = values.groupby(['uid', 'val'], sort=False)['pos'].agg(['size', 'min']).reset_index()
+    counts['max'] = counts.groupby('uid')['size'].transform('max')
+    counts = counts[counts['size'] == counts['max']]
+    counts['usefulness'] = 0.0
+    if series.name in TEXT_FIELDS:
+        ties = counts['uid'].duplicated(keep=False)
+        counts.loc[ties, 'usefulness'] = [get_usefulness(v) for v in counts.loc[ties, 'val']]
+    # Most frequent, then most useful for text, then first seen like value_counts
+    counts = counts.sort_values(['uid', 'usefulness', 'min'], ascending=[True, False, True])
+    return counts.drop_duplicates('uid').set_index('uid')['val']
+
+
+def make_payments(df):
+    payments = make_payments_table(df)
+    uids = payments.pop('uid')
+    dumped = pd.Series([json.dumps(r) for r in payments.to_dict('records')], index=uids.values)
+    return dumped.groupby(level=0, sort=False).agg(lambda x: '[%s]' % ', '.join(x))
+
+
+def make_entities_fast(df):
+    # Vectorized make_entities_df
+    uids = df['uid'].values
+    index = pd.Index(sorted(df['uid'].dropna().unique()))
+    entities = pd.DataFrame(index=index)
+    for column in entity_columns(df):
+        best = best_values(uids, df[column])
+        entities[column] = pd.Series(best.reindex(index).values, index=index, dtype=object)
+        entities.loc[~index.isin(best.index), column] = None
+    entities['payments'] = make_payments(df).reindex(index).fillna('[]')
+    entities.insert(0, 'uid', index)
+    return entities.reset_index(drop=True).astype(object)
+
+
 def make_slug(x):
     slug_list = [slugify(x['name'] or ''), slugify(x['location'] or '')]
     origin = x['origin'].lower()
@@ -70,17 +116,131 @@ def make_slug(x):
     return '-'.join(slug_list)
 
 
-def make_slugs(df):
+# uid goes last: it only orders entities that agree on everything else, and keeps their keys apart
+SLUG_ORDER = ['name', 'location', 'address', 'postcode', 'first_name', 'last_name', 'uid']
+SLUG_SUFFIX = re.compile('-(\\d+)$')
+
+
+def _slugify_column(series):
+    cache = {v: slugify(v) for v in series.dropna().unique()}
+    return series.map(cache).fillna('')
+
+
+def make_slug_raws(df):
+    slug_raw = _slugify_column(df['name']) + '-' + _slugify_column(df['location'])
+    origin = df['origin'].str.lower()
+    slug_raw = slug_raw.where(origin == 'de', slug_raw + '-' + origin.fillna(''))
+    return slug_raw.str.replace('-+', '-', regex=True).str.strip('-')
 
-    df['slug_raw'] = df.apply(make_slug, 1)
 
-    df['slug'] = df['slug_raw'].copy()
-    groups = df.groupby('slug_raw')
-    for key, group_df in groups:
-        if len(group_df) < 2:
-            continue
-        for i, (index, row) in enumerate(group_df.iterrows()):
-            if i == 0:
-                continue
-            df.set_value(index, 'slug', '%s-%s' % (row['slug_raw'], i))
+def slug_keys(df):
+    # Content key that orders rows of a slug group independent of row order
+    columns = [c for c in SLUG_ORDER if c in df]
+    keys = pd.Series('', index=df.index)
+    for column in columns:
+        keys = keys + '|' + df[column].astype(object).fillna('').astype(str)
+    return keys
+
+
+def _suffix(slug, slug_raw):
+    if slug == slug_raw:
+        return 0
+    if isinstance(slug, str) and slug.startswith(slug_raw):
+        match = SLUG_SUFFIX.match(slug[len(slug_raw):])
+        if match is not None:
+            return int(match.group(1))
+    return None
+
+
+def make_slugs(df, previous=None):
+    df['slug_raw'] = make_slug_raws(df)
+    keys = slug_keys(df)
+
+    kept = pd.Series(np.nan, index=df.index)
+    if previous:
+        # Entities that had a slug before keep it, as long as it still fits their raw slug
+        old = keys.map(previous)
+        kept = pd.Series([_suffix(slug, raw) if pd.notnull(slug) else None
+                          for slug, raw in zip(old, df['slug_raw'])], index=df.index, dtype=float)
+        kept[pd.DataFrame({'raw': df['slug_raw'], 'kept': kept}).duplicated() & kept.notnull()] = np.nan
+
+    new = kept.isnull()
+    offset = kept.groupby(df['slug_raw']).transform('max').fillna(-1) + 1
+    ordered = pd.DataFrame({'raw': df['slug_raw'], 'key': keys})[new].sort_values(['raw', 'key'], kind='stable')
+    suffix = kept.copy()
+    suffix[ordered.index] = ordered.groupby('raw').cumcount() + offset[ordered.index]
+    suffix = suffix.astype(int)
+
+    df['slug'] = df['slug_raw'].where(suffix == 0, df['slug_raw'] + '-' + suffix.astype(str))
     return df
+
+
+def previous_slugs(df):
+    return dict(zip(slug_keys(df), df['slug']))
+
+
+class SlugRegistry(object):
+    def __init__(self, issued=()):
+        self.counts = {}
+        self.issued = set(issued)
+
+    def assign(self, entity):
+        slug_raw = make_slug(entity)
+        count = self.counts.get(slug_raw, 0)
+        slug = slug_raw if count == 0 else '%s-%s' % (slug_raw, count)
+        # A raw slug can look like a suffixed one, never hand out a slug twice
+        while slug in self.issued:
+            count += 1
+            slug = '%s-%s' % (slug_raw, count)
+        self.counts[slug_raw] = count + 1
+        self.issued.add(slug)
+        return slug_raw, slug
+
+
+def _clean_value(val):
+    if isinstance(val, float) and val != val:
+        return None
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+def clean_entity(entity):
+    entity = {k: _clean_value(v) for k, v in entity.items()}
+    if isinstance(entity.get('payments'), list):
+        entity['payments'] = [{k: _clean_value(v) for k, v in p.items()} for p in entity['payments']]
+    return entity
+
+
+def stream_entities(df, registry=None, nested=True):
+    registry = registry or SlugRegistry()
+    for entity in make_entities(df, nested=nested):
+        entity['slug_raw'], entity['slug'] = registry.assign(entity)
+        yield clean_entity(entity)
+
+
+def write_ndjson(df, filename, registry=None):
+    count = 0
+    with open(filename, 'w', encoding='utf-8') as f:
+        for entity in stream_entities(df, registry=registry):
+            f.write(json.dumps(entity, ensure_ascii=False))
+            f.write('\n')
+            count += 1
+    return count
+
+
+def write_csv(df, filename, registry=None, chunk_size=1000):
+    columns = ['uid'] + sorted(entity_columns(df)) + ['payments', 'slug_raw', 'slug']
+    chunk = []
+    count = 0
+    with open(filename, 'w', encoding='utf-8', newline='') as f:
+        for entity in stream_entities(df, registry=registry, nested=False):
+            chunk.append(entity)
+            if len(chunk) >= chunk_size:
+                pd.DataFrame(chunk, columns=columns).to_csv(f, index=False, header=count == 0)
+                count += len(chunk)
+                chunk = []
+        if chunk or count == 0:
+            pd.DataFrame(chunk, columns=columns).to_csv(f, index=False, header=count == 0)
+            count += len(chunk)
+    return count
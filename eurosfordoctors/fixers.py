@@ -1,3 +1,4 @@
+import logging
 import re
 from collections import Counter
 
@@ -7,6 +8,8 @@ import pandas as pd
 from slugify import slugify
 
 
+logger = logging.getLogger(__name__)
+
 MONEY_FIELDS = 'donations_grants	sponsorship	registration_fees	travel_accommodation	fees	related_expenses	total'.split()
 CURRENCY_RE = re.compile('EUR|Euro|€|CHF', re.I)
 DECIMAL_RE = re.compile('.*([\.,])\d{1,2}$')
@@ -17,6 +20,7 @@ NORMALIZE_STREET = re.compile('([Ss])(trasse|traße)($|\W)', re.U | re.I)
 MULTI_SPACE = re.compile('\s+')
 MALE_GENDER = re.compile('^(Herrn?|Mr\.|Monsieur)\s+', re.I)
 FEMALE_GENDER = re.compile('^(Frau|Mrs\.|Signora)\s+', re.I)
+LAST_NAME_CAPITALS = re.compile('^([^a-z]+) ((?:[A-ZÖÜÄ][^A-Z]+)+)$')
 CLEAN_NAME = re.compile('^([\w\-]{2,})(?:\s+[A-Z]\.?)*\s([\w\-]{2,})')
 PUNCTUATION = re.compile('^(.*)[\W\D]?$')
 NAME_DASH_SPACE = re.compile('[a-z]\-(\s+)')
@@ -29,28 +33,65 @@ ORGANISED_BY = re.compile('^(organi?siert|org\. )?(durch|von)?:?\s?', re.I)
 WORDS_ONLY = re.compile('^\w+$')
 NO_WORDS = re.compile('\W')
 
-REPLACEMENTS = {
-    'e. V.': 'e.V.'
-}
 
-RE_NAME_FIXES = {
-    '0A': 'OA',
-    '([a-z])\-\s+([A-Z])': '\\1-\\2',
-    ' ße ': 'ße ',
-    ';\s*$': '',
-    '\.(\d)': '. \\1',
-    r'^[\W_]*(.*?)[\W_]*$': '\\1',
-    '\s': ' ',
-    '\.\.\.': '',
-}
+def rec(x, *args):
+    return re.compile(x, *args)
 
-RE_REPLACEMENTS = {
-    '(\S)e\.V\.': '\\1 e.V.'
-}
 
+class FixTable(object):
+    # Rules are applied in the declared order, each one sees the output of the last.
+    # That makes merging rules into one alternation unsafe, so they stay separate
+    # but are compiled once. hits counts the values each rule changed.
+    def __init__(self, rules):
+        self.rules = [(rec(k) if isinstance(k, str) else k, v) for k, v in rules]
+        self.hits = Counter()
 
-def rec(x, *args):
-    return re.compile(x, *args)
+    def items(self):
+        return [(k.pattern, v) for k, v in self.rules]
+
+    def sub(self, val):
+        for i, (k, v) in enumerate(self.rules):
+            new_val = k.sub(v, val)
+            if new_val != val:
+                self.hits[i] += 1
+            val = new_val
+        return val
+
+    def sub_series(self, series, weights=None):
+        # weights: how many rows each value stands for, when the series holds distinct values
+        for i, (k, v) in enumerate(self.rules):
+            new_series = series.str.replace(k, v, regex=True)
+            changed = ((new_series != series) & series.notnull()).values
+            self.hits[i] += int(changed.sum() if weights is None else weights[changed].sum())
+            series = new_series
+        return series
+
+    def report(self):
+        return [(k.pattern, v, self.hits[i]) for i, (k, v) in enumerate(self.rules)]
+
+    def reset(self):
+        self.hits.clear()
+
+
+RE_NAME_FIXES = FixTable([
+    ('0A', 'OA'),
+    ('([a-z])\-\s+([A-Z])', '\\1-\\2'),
+    (' ße ', 'ße '),
+    (';\s*$', ''),
+    ('\.(\d)', '. \\1'),
+    (r'^[\W_]*(.*?)[\W_]*$', '\\1'),
+    ('\s', ' '),
+    ('\.\.\.', ''),
+])
+
+# Literal replacements, they run first in RE_REPLACEMENTS
+REPLACEMENTS = {
+    'e. V.': 'e.V.'
+}
+
+RE_REPLACEMENTS = FixTable([(re.escape(k), v) for k, v in REPLACEMENTS.items()] + [
+    ('(\S)e\.V\.', '\\1 e.V.'),
+])
 
 TITLES = (
     rec(u'Dipl?\.\-?[\w\.-]+(?:\s?\(FH\))?', re.I),
@@ -61,6 +102,7 @@ TITLES = (
     rec('(?:Chef)?[Aa]potheker(?:in)?', re.I),
 )
 
+
 weirdspace_counter = Counter()
 
 
@@ -72,24 +114,23 @@ def weirdspace_replace(matchobj):
     return '%s%s%s%s' % matchobj.groups()
 
 
+PDF_SPACE_FIXES = FixTable([
+    (WEIRD_SPACE, weirdspace_replace),
+])
+
+
 def pdf_space_fixer(val):
     # Breaks more things than it fixes
     return val
-    # return WEIRD_SPACE.sub(weirdspace_replace, val)
+    # return PDF_SPACE_FIXES.sub(val)
 
 
 def apply_name_fixes(val, fixes=RE_NAME_FIXES):
-    for k, v in fixes.items():
-        val = re.sub(k, v, val)
-    return val
+    return fixes.sub(val)
 
 
 def replace_words(val):
-    for k, v in REPLACEMENTS.items():
-        val = val.replace(k, v)
-    for k, v in RE_REPLACEMENTS.items():
-        val = re.sub(k, v, val)
-    return val
+    return RE_REPLACEMENTS.sub(val)
 
 
 def get_titles(name):
@@ -119,33 +160,40 @@ def get_titles(name):
     return titles, new_name
 
 
+def split_hco_name_value(name):
+    split_name = HCO_SUB_NAME_SPLITTER.split(name, 1)
+    if len(split_name) < 2:
+        return None
+    success = True
+    name, detail = split_name
+    if name.endswith('-'):
+        success = False
+    detail = detail.strip()
+    if detail.endswith(')'):
+        detail = detail.replace(')', '')
+    match = ORGANISED_BY.search(detail)
+    if match and len(match.group(0)) > 4:
+        # Switch around
+        detail = ORGANISED_BY.sub('', detail)
+        name, detail = detail, name
+
+    match = ORGANISED_BY.search(name)
+    if match and len(match.group(0)) > 4:
+        name = ORGANISED_BY.sub('', name)
+
+    if len(name) < 5 or (is_upper(NO_WORDS.sub('', name)) and len(name) < 6):
+        success = False
+    if detail.strip().startswith('und'):
+        success = False
+    if success:
+        return name, detail
+    return None
+
+
 def split_hco_name(row, COMPANY_SETTINGS):
-    split_name = HCO_SUB_NAME_SPLITTER.split(row['name'], 1)
-    if len(split_name) > 1:
-        success = True
-        name, detail = split_name
-        if name.endswith('-'):
-            success = False
-        detail = detail.strip()
-        if detail.endswith(')'):
-            detail = detail.replace(')', '')
-        match = ORGANISED_BY.search(detail)
-        if match and len(match.group(0)) > 4:
-            # Switch around
-            detail = ORGANISED_BY.sub('', detail)
-            name, detail = detail, name
-
-        match = ORGANISED_BY.search(name)
-        if match and len(match.group(0)) > 4:
-            name = ORGANISED_BY.sub('', name)
-
-        if len(name) < 5 or (is_upper(NO_WORDS.sub('', name)) and len(name) < 6):
-            success = False
-        if detail.strip().startswith('und'):
-            success = False
-        if success:
-            row['name'] = name
-            row['recipient_detail'] = detail
+    split_name = split_hco_name_value(row['name'])
+    if split_name is not None:
+        row['name'], row['recipient_detail'] = split_name
     # row['name'] = NAME_DASH_SPACE.sub('', row['name'])
     row['name'] = ENDS_DASH.sub('', row['name']).strip()
     if row['company'] not in COMPANY_SETTINGS['no_pdf']:
@@ -167,7 +215,7 @@ def split_name(row, COMPANY_SETTINGS):
     else:
         if row['company'] in COMPANY_SETTINGS['bad_name_order']:
             if row['company'] in COMPANY_SETTINGS.get('last_name_capitals', []):
-                name_list = re.match('^([^a-z]+) ((?:[A-ZÖÜÄ][^A-Z]+)+)$', name)
+                name_list = LAST_NAME_CAPITALS.match(name)
                 if name_list is None:
                     print(name, row['company'], row)
                 name_list = [name_list.group(1), name_list.group(2)]
@@ -336,21 +384,68 @@ def fix_money(val):
     return val
 
 
-def make_money(df):
+def fix_money_series(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series
+    is_str = series.str.len().notnull()
+    raw = series[is_str]
+    val = raw.str.replace("'", '', regex=False)  # Swiss thousand separator
+    empty = (raw == '-') | val.isin(['N/A', 'NA'])
+
+    val = val.str.replace(CURRENCY_RE, '', regex=True).str.strip()
+    val = val.str.replace(' ', '', regex=False)
+
+    comma_decimal = val.str.extract(DECIMAL_RE, expand=False) == ','
+    val = val.where(~comma_decimal, val.str.replace('.', '', regex=False))
+    val = val.str.replace(',', '.', regex=False).where(comma_decimal, val.str.replace(',', '', regex=False))
+
+    series = series.astype(object)
+    series[is_str] = val.where(~empty, None)
+    return series
+
+
+def make_money(df, errors=None):
+    # Pass a Counter as errors to get the unparsed values per (company, field) instead of a log
+    if errors is None:
+        errors = Counter()
+        report = True
+    else:
+        report = False
+    companies = df['company'] if 'company' in df else pd.Series('', index=df.index)
     for field in MONEY_FIELDS:
         if field not in df:
             continue
         df[field + '_dirty'] = df[field]
-        df[field] = df[field].apply(fix_money)
-        try:
-            df[field] = pd.to_numeric(df[field])
-            df[field] = df[field].apply(lambda x: np.nan if x <= 0 else x)
-        except ValueError as e:
-            print(field)
-            raise e
+        cleaned = fix_money_series(df[field])
+        money = pd.to_numeric(cleaned, errors='coerce')
+        # Blank cells are missing values, not unparsed ones
+        blank = cleaned.astype(str).str.strip() == ''
+        unparsed = money.isnull() & cleaned.notnull() & ~blank
+        if unparsed.any():
+            for company, count in companies[unparsed].value_counts().items():
+                errors[(company, field)] += count
+        df[field] = money.where(money > 0)
+    if report and errors:
+        for (company, field), count in sorted(errors.items()):
+            logger.warning('%s: %d unparsed values in %s', company, count, field)
     return df
 
 
+def parse_address_location_country_comma(s):
+    s = s.rsplit(',', 2)
+    return {
+        'country': (' '.join(s[2:])).strip(),
+        'location': s[1].strip(),
+        'address': s[0].strip()
+    }
+
+
+# Address rules that config files can refer to by name
+ADDRESS_PARSERS = {
+    'address_location_country_comma': parse_address_location_country_comma,
+}
+
+
 def fix_country(val, default='DE'):
     if pd.isnull(val):
         return default
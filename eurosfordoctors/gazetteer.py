@@ -0,0 +1,203 @@
+import re
+
+import numpy as np
+import pandas as pd
+from slugify import slugify
+
+from .spatial import haversine
+
+
+COLUMNS = ['country', 'postcode', 'city', 'lat', 'lng']
+# GeoNames postal code dumps, tab separated without a header
+GEONAMES_COLUMNS = ['country', 'postcode', 'city', 'admin1', 'admin1_code', 'admin2', 'admin2_code',
+                    'admin3', 'admin3_code', 'lat', 'lng', 'accuracy']
+# Places of one name further apart than this are different places, their name alone resolves nothing
+MAX_CITY_SPREAD_KM = 25.0
+SPREAD_QUANTILE = 0.9
+POSTCODE_SEPARATORS = re.compile(r'[\s-]+')
+# What resolve placed a row on, many rows share one of these points
+CENTROIDS = ('postcode', 'city')
+
+
+def normalize_postcode(val):
+    # 00-950, 00 950 and 00950 are the same postcode
+    return POSTCODE_SEPARATORS.sub('', str(val)).upper()
+
+
+def normalize_city(val):
+    # awesome-slugify keeps the case
+    return slugify(str(val)).lower()
+
+
+def _normalize(values, func):
+    values = pd.Series(np.asarray(values, dtype=object))
+    normalized = {v: func(v) for v in values.dropna().unique()}
+    return values.map(normalized).fillna('').values
+
+
+def make_keys(country, values):
+    country = pd.Series(np.asarray(country, dtype=object)).fillna('').astype(str).str.strip().str.lower()
+    return (country + '|' + pd.Series(np.asarray(values, dtype=object)).astype(str)).values.astype(str)
+
+
+def _search(keys, query):
+    # Positions of the query keys in the sorted keys and whether they are there
+    if not len(keys):
+        return np.zeros(len(query), dtype=np.int64), np.zeros(len(query), dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return pos, keys[pos] == query
+
+
+def _take(values, pos, hit):
+    if not len(values):
+        return np.full(len(pos), np.nan)
+    return np.where(hit, values[pos], np.nan)
+
+
+def _most_common(df, keys, column):
+    counts = df.groupby(keys + [column]).size().rename('count').reset_index()
+    counts = counts.sort_values('count', ascending=False, kind='stable').drop_duplicates(keys)
+    return counts.set_index(keys)[column]
+
+
+class Gazetteer(object):
+    # Centroids by country and postcode and by country and normalized city, in sorted arrays
+    def __init__(self, places, max_spread_km=MAX_CITY_SPREAD_KM):
+        places = pd.DataFrame({c: np.asarray(places[c], dtype=object) for c in COLUMNS})
+        places['lat'] = pd.to_numeric(places['lat'], errors='coerce')
+        places['lng'] = pd.to_numeric(places['lng'], errors='coerce')
+        places = places[places['lat'].notnull() & places['lng'].notnull()]
+        # Keys are normalized, lookups return the most common spelling
+        for column in ('postcode', 'city'):
+            places['%s_name' % column] = places[column].astype(str).str.strip().where(places[column].notnull(), '')
+        places['postcode'] = _normalize(places['postcode'], normalize_postcode)
+        places['city'] = _normalize(places['city'], normalize_city)
+        places['country'] = places['country'].fillna('').astype(str).str.strip().str.lower()
+
+        with_postcode = places[places['postcode'] != '']
+        keys = ['country', 'postcode']
+        postcodes = with_postcode.groupby(keys).agg(lat=('lat', 'median'), lng=('lng', 'median'))
+        for column in ('city', 'postcode_name', 'city_name'):
+            postcodes[column] = _most_common(with_postcode, keys, column)
+        postcodes = postcodes.reset_index()
+        postcodes['key'] = make_keys(postcodes['country'], postcodes['postcode'])
+        postcodes['city_key'] = make_keys(postcodes['country'], postcodes['city'])
+        postcodes = postcodes.sort_values('key')
+        self.postcode_keys = postcodes['key'].values.astype(str)
+        self.postcode_lat = postcodes['lat'].values
+        self.postcode_lng = postcodes['lng'].values
+        self.postcodes = postcodes['postcode_name'].values.astype(object)
+        self.postcode_cities = postcodes['city_name'].values.astype(object)
+        # The same postcodes ordered by city for nearest postcode lookups
+        by_city = np.argsort(postcodes['city_key'].values.astype(str), kind='stable')
+        self.by_city = by_city
+        self.by_city_keys = postcodes['city_key'].values.astype(str)[by_city]
+
+        places = places[places['city'] != ''].copy()
+        places['key'] = make_keys(places['country'], places['city'])
+        cities = places.groupby('key').agg(lat=('lat', 'median'), lng=('lng', 'median'))
+        centroids = cities.reindex(places['key'])
+        distance = haversine(places['lat'].values, places['lng'].values, centroids['lat'].values,
+                             centroids['lng'].values)
+        # A few misplaced points, e.g. a postcode geocoded to another city, don't make a name ambiguous
+        distance = pd.Series(distance, index=places.index)
+        cities['spread'] = distance.groupby(places['key'].values).quantile(SPREAD_QUANTILE)
+        self.city_keys = cities.index.values.astype(str)
+        self.city_lat = cities['lat'].values
+        self.city_lng = cities['lng'].values
+        self.city_ambiguous = (cities['spread'] > max_spread_km).values
+
+    def __len__(self):
+        return len(self.postcode_keys)
+
+    @classmethod
+    def read_csv(cls, filename, **kwargs):
+        # country, postcode, city, lat, lng like Gazetteer.to_csv writes
+        return cls(pd.read_csv(filename, dtype={'postcode': str}, keep_default_na=False,
+                               na_values=['']), **kwargs)
+
+    @classmethod
+    def read_geonames(cls, filename, **kwargs):
+        return cls(pd.read_csv(filename, sep='\t', header=None, names=GEONAMES_COLUMNS, dtype={'postcode': str},
+                               keep_default_na=False, na_values=[''], quoting=3), **kwargs)
+
+    @classmethod
+    def from_cache(cls, cache, **kwargs):
+        # Places geocoded before, street level points become postcode and city centroids
+        return cls(pd.DataFrame(list(cache.places()), columns=COLUMNS), **kwargs)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        if filename.endswith('.db'):
+            from .geocache import GeoCache
+
+            cache = GeoCache(filename)
+            try:
+                return cls.from_cache(cache, **kwargs)
+            finally:
+                cache.close()
+        if filename.endswith('.txt'):
+            return cls.read_geonames(filename, **kwargs)
+        return cls.read_csv(filename, **kwargs)
+
+    def to_csv(self, filename):
+        # Postcode centroids only, city centroids are computed from them again on reading
+        countries = [k.split('|', 1)[0] for k in self.postcode_keys]
+        pd.DataFrame({'country': countries, 'postcode': self.postcodes, 'city': self.postcode_cities,
+                      'lat': self.postcode_lat, 'lng': self.postcode_lng}).to_csv(filename, index=False)
+
+    def postcode_centroids(self, country, postcode):
+        keys = make_keys(country, _normalize(postcode, normalize_postcode))
+        pos, hit = _search(self.postcode_keys, keys)
+        return _take(self.postcode_lat, pos, hit), _take(self.postcode_lng, pos, hit)
+
+    def city_centroids(self, country, city):
+        # NaN for unknown and ambiguous names
+        keys = make_keys(country, _normalize(city, normalize_city))
+        pos, hit = _search(self.city_keys, keys)
+        if len(self.city_keys):
+            hit &= ~self.city_ambiguous[pos]
+        return _take(self.city_lat, pos, hit), _take(self.city_lng, pos, hit)
+
+    def resolve(self, country, postcode, city):
+        # The postcode centroid, else the centroid of an unambiguous city name, and which one it is
+        lat, lng = self.postcode_centroids(country, postcode)
+        city_lat, city_lng = self.city_centroids(country, city)
+        missing = np.isnan(lat)
+        level = np.where(missing, np.where(np.isnan(city_lat), None, 'city'), 'postcode').astype(object)
+        return np.where(missing, city_lat, lat), np.where(missing, city_lng, lng), level
+
+    def nearest_postcodes(self, country, city, lat, lng):
+        # Postcode of the city closest to each point, None without a city match or coordinates
+        keys = make_keys(country, _normalize(city, normalize_city))
+        lat, lng = np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)
+        result = np.full(len(keys), None, dtype=object)
+        valid = np.nonzero(~(np.isnan(lat) | np.isnan(lng)))[0]
+        for key, rows in pd.Series(valid).groupby(keys[valid]):
+            start = np.searchsorted(self.by_city_keys, key, side='left')
+            end = np.searchsorted(self.by_city_keys, key, side='right')
+            if start == end:
+                continue
+            rows = rows.values
+            candidates = self.by_city[start:end]
+            distance = haversine(lat[rows, None], lng[rows, None], self.postcode_lat[candidates][None, :],
+                                 self.postcode_lng[candidates][None, :])
+            result[rows] = self.postcodes[candidates[distance.argmin(axis=1)]]
+        return result
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m eurosfordoctors.gazetteer',
+                                     description='Write a postcode gazetteer CSV.')
+    parser.add_argument('source', help='geocoding .db, GeoNames .txt or gazetteer CSV')
+    parser.add_argument('output', help='gazetteer CSV')
+    args = parser.parse_args(argv)
+    gazetteer = Gazetteer.load(args.source)
+    gazetteer.to_csv(args.output)
+    print('%d postcodes, %d cities' % (len(gazetteer), len(gazetteer.city_keys)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import zlib
+from collections import namedtuple
+
+
+SCHEMA_VERSION = 2
+LEGACY_TABLE = 'geocoding'
+QUERY_CHUNK = 500
+
+Entry = namedtuple('Entry', 'lat lng postal')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS geocache (
+    key TEXT PRIMARY KEY,
+    country TEXT NOT NULL,
+    location TEXT NOT NULL,
+    lat REAL,
+    lng REAL,
+    postal TEXT,
+    status TEXT,
+    payload BLOB
+) WITHOUT ROWID
+'''
+
+
+def normalize_key(country, location):
+    country = (country or '').strip().lower()
+    location = ' '.join((location or '').split()).lower()
+    return '%s|%s' % (country, location)
+
+
+def compress(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def decompress(blob):
+    if blob is None:
+        return None
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+def _properties(geojson):
+    if not geojson:
+        return {}
+    return geojson.get('properties') or {}
+
+
+class GeoCache(object):
+    def __init__(self, path='geocoding.db', store_payload=True):
+        self.path = path
+        self.store_payload = store_payload
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.migrate()
+
+    def version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def has_table(self, name):
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (name,)).fetchone() is not None
+
+    def migrate(self):
+        version = self.version()
+        if version >= SCHEMA_VERSION:
+            return
+        legacy = self.has_table(LEGACY_TABLE)
+        with self.conn:
+            self.conn.execute(SCHEMA)
+            if legacy and version < 1:
+                self._import_legacy()
+            # Version 2: the legacy table is imported, drop it and give its pages back
+            if legacy:
+                self.conn.execute('DROP TABLE %s' % LEGACY_TABLE)
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        if legacy:
+            self.conn.execute('VACUUM')
+
+    def _import_legacy(self):
+        # Tables created by dataset: id, country, location, lat, lng, geojson
+        cursor = self.conn.execute('SELECT country, location, lat, lng, geojson FROM %s ORDER BY id'
+                                   % LEGACY_TABLE)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(QUERY_CHUNK)
+            if not rows:
+                break
+            # The first entry wins, like find_one did
+            self._insert(((country, location, lat, lng, json.loads(geojson) if geojson else None)
+                          for country, location, lat, lng, geojson in rows), replace=False)
+            count += len(rows)
+        print('Migrated %d geocoding entries' % count)
+
+    def _insert(self, rows, replace=True):
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        self.conn.executemany(
+            verb + ' INTO geocache (key, country, location, lat, lng, postal, status, payload) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            [(normalize_key(country, location), country or '', location or '', lat, lng,
+              _properties(geojson).get('postal'), _properties(geojson).get('status'),
+              compress(geojson) if self.store_payload and geojson else None)
+             for country, location, lat, lng, geojson in rows]
+        )
+
+    def put_many(self, rows):
+        # rows of (country, location, lat, lng, geojson), written in one transaction
+        with self.conn:
+            self._insert(rows)
+
+    def put(self, country, location, lat, lng, geojson=None):
+        self.put_many([(country, location, lat, lng, geojson)])
+
+    def get_many(self, keys):
+        keys = list(keys)
+        normalized = {}
+        for country, location in keys:
+            normalized.setdefault(normalize_key(country, location), []).append((country, location))
+        found = {}
+        lookup = list(normalized)
+        for start in range(0, len(lookup), QUERY_CHUNK):
+            chunk = lookup[start:start + QUERY_CHUNK]
+            query = ('SELECT key, lat, lng, postal FROM geocache WHERE key IN (%s)'
+                     % ', '.join('?' * len(chunk)))
+            for key, lat, lng, postal in self.conn.execute(query, chunk):
+                for original in normalized[key]:
+                    found[original] = Entry(lat, lng, postal)
+        return found
+
+    def get(self, country, location):
+        return self.get_many([(country, location)]).get((country, location))
+
+    def payload(self, country, location):
+        row = self.conn.execute('SELECT payload FROM geocache WHERE key = ?',
+                                (normalize_key(country, location),)).fetchone()
+        if row is None:
+            return None
+        return decompress(row[0])
+
+    def places(self):
+        # (country, postcode, city, lat, lng) of every found location, the city from the stored
+        # payload or else the last part of the search
+        cursor = self.conn.execute('SELECT country, location, lat, lng, postal, payload FROM geocache '
+                                   'WHERE lat IS NOT NULL AND lng IS NOT NULL')
+        for country, location, lat, lng, postal, payload in cursor:
+            city = _properties(decompress(payload)).get('city')
+            if not city and ',' in location:
+                city = location.rpartition(',')[2].strip()
+            yield country, postal, city, lat, lng
+
+    def drop_payloads(self):
+        with self.conn:
+            self.conn.execute('UPDATE geocache SET payload = NULL')
+        self.conn.execute('VACUUM')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM geocache').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
@@ -1,15 +1,54 @@
 import os
-import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import numpy as np
 import pandas as pd
 import geocoder
-import dataset
+import requests
+
+from .geocache import GeoCache, normalize_key
+from .metrics import Progress
 
 
 DIR_PATH = os.path.abspath(os.path.dirname(__file__))
 API_KEY = open(os.path.join(DIR_PATH, 'apikey.txt')).read().strip()
 
-db = dataset.connect('sqlite:///geocoding.db')
+CACHE_PATH = 'geocoding.db'
+
+OVER_QUERY_LIMIT = 'OVER_QUERY_LIMIT'
+WORKERS = 4
+RATE = 10.0
+RETRIES = 5
+BACKOFF = 1.0
+BATCH_SIZE = 500
+# street: only rows without an address come from the gazetteer, city: every row it can resolve
+LEVELS = ('street', 'city')
+# geo_precision of rows placed by the provider or its cache, the others are gazetteer.CENTROIDS
+GEOCODED = 'geocoded'
+
+
+class OverQueryLimit(Exception):
+    pass
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = GeoCache(CACHE_PATH)
+    return _cache
+
+
+def use_cache(path):
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = GeoCache(path)
+    return _cache
 
 
 def get_search(row):
@@ -18,14 +57,14 @@ def get_search(row):
 
 
 def geocode(row, country='de'):
-    table = db['geocoding']
+    cache = get_cache()
     kwargs = {'key': API_KEY, 'language': country}
     if pd.notnull(row['country']):
         kwargs.update({'components': 'country:%s' % row['country']})
         country = row['country']
     search = get_search(row)
 
-    result = table.find_one(country=country, location=search)
+    result = cache.get(country, search)
     if result is None:
         geocoding_result = geocoder.google(search, **kwargs)
         latlng = [None, None]
@@ -33,11 +72,9 @@ def geocode(row, country='de'):
             raise Exception('Over query API limit')
         if geocoding_result and geocoding_result.latlng:
             latlng = geocoding_result.latlng
-        table.insert(dict(country=country, location=search,
-                          lat=latlng[0], lng=latlng[1],
-                          geojson=json.dumps(geocoding_result.geojson)))
+        cache.put(country, search, latlng[0], latlng[1], geocoding_result.geojson)
         return latlng
-    return (result['lat'], result['lng'])
+    return (result.lat, result.lng)
 
 
 def run_geocoding(row, country='de'):
@@ -48,14 +85,218 @@ def run_geocoding(row, country='de'):
 def get_postcode(row):
     if pd.notnull(row['postcode']):
         return row['postcode']
-    table = db['geocoding']
     country = ''
     if pd.notnull(row['country']):
         country = row['country']
     search = get_search(row)
 
-    result = table.find_one(country=country, location=search)
+    result = get_cache().get(country, search)
     if result is None:
         return None
-    data = json.loads(result['geojson'])
-    return data['properties'].get('postal')
+    return result.postal
+
+
+def fill_postcodes(df, gazetteer=None):
+    missing = df['postcode'].isnull()
+    countries = df.loc[missing, 'country'].astype(object).where(df.loc[missing, 'country'].notnull(), '')
+    keys = list(zip(countries, get_searches(df[missing])))
+    found = get_cache().get_many(set(keys))
+    df = df.copy()
+    df['postcode'] = df['postcode'].astype(object)
+    df.loc[missing, 'postcode'] = [found[key].postal if key in found else None for key in keys]
+    if gazetteer is not None and 'lat' in df:
+        # The nearest postcode of the row's city for everything the cache doesn't know
+        missing = df['postcode'].isnull()
+        rows = df[missing]
+        df.loc[missing, 'postcode'] = gazetteer.nearest_postcodes(
+            rows['country'].astype(object).where(rows['country'].notnull(), ''), rows['location'].values,
+            rows['lat'].values, rows['lng'].values)
+    return df
+
+
+def google_provider(search, language, country=None):
+    kwargs = {'key': API_KEY, 'language': language}
+    if country is not None:
+        kwargs.update({'components': 'country:%s' % country})
+    result = geocoder.google(search, **kwargs)
+    if result.geojson['properties']['status'] == OVER_QUERY_LIMIT:
+        raise OverQueryLimit('Over query API limit')
+    latlng = [None, None]
+    if result and result.latlng:
+        latlng = result.latlng
+    return latlng, result.geojson
+
+
+def _component(components, kind):
+    for component in components:
+        if kind in component.get('types', []):
+            return component.get('long_name')
+    return None
+
+
+def json_provider(search, language, country=None, url=None, key=None, timeout=30):
+    # Speaks the Google geocoding JSON API, e.g. a local stub server
+    params = {'address': search, 'language': language}
+    if country is not None:
+        params['components'] = 'country:%s' % country
+    if key is not None:
+        params['key'] = key
+    response = requests.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    status = data.get('status')
+    if status == OVER_QUERY_LIMIT:
+        raise OverQueryLimit('Over query API limit')
+    properties = {'status': status, 'address': search}
+    latlng = [None, None]
+    if data.get('results'):
+        result = data['results'][0]
+        location = result['geometry']['location']
+        latlng = [location['lat'], location['lng']]
+        components = result.get('address_components', [])
+        properties.update({
+            'lat': latlng[0], 'lng': latlng[1],
+            'address': result.get('formatted_address', search),
+            'postal': _component(components, 'postal_code'),
+            'city': _component(components, 'locality'),
+            'country': _component(components, 'country'),
+        })
+    geojson = {'type': 'Feature', 'properties': properties}
+    if latlng[0] is not None:
+        geojson['geometry'] = {'type': 'Point', 'coordinates': [latlng[1], latlng[0]]}
+    return latlng, geojson
+
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_call = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _lookup(provider, limiter, search, language, country, retries, backoff):
+    for attempt in range(retries + 1):
+        limiter.wait()
+        try:
+            return provider(search, language, country)
+        except OverQueryLimit:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def get_searches(df):
+    parts = []
+    for col in ('address', 'location'):
+        series = df[col].astype(object) if col in df else pd.Series(None, index=df.index, dtype=object)
+        valid = series.notnull() & (series.astype(str) != '')
+        parts.append((series.where(valid, '').astype(str), valid))
+    (address, has_address), (location, has_location) = parts
+    search = address.where(~(has_address & has_location), address + ', ' + location)
+    search = search.where(has_address, location)
+    return search.str.strip()
+
+
+def load_cache(keys):
+    found = get_cache().get_many(keys)
+    return {normalize_key(*key): (entry.lat, entry.lng) for key, entry in found.items()}
+
+
+def _write_batch(rows):
+    if not rows:
+        return
+    get_cache().put_many(rows)
+    del rows[:]
+
+
+def gazetteer_lookup(df, positions, countries, gazetteer, level='street'):
+    # Coordinates for the rows at positions that need no street level lookup
+    if level not in LEVELS:
+        raise ValueError('Unknown geocoding level: %s' % level)
+    positions, countries = np.asarray(positions, dtype=np.int64), np.asarray(countries, dtype=object)
+    if level == 'street' and 'address' in df:
+        address = df['address'].astype(object).values[positions]
+        local = np.array([pd.isnull(a) or not str(a).strip() for a in address], dtype=bool)
+        positions, countries = positions[local], countries[local]
+    rows = df.iloc[positions]
+    postcodes = rows['postcode'].values if 'postcode' in rows else [None] * len(rows)
+    lat, lng, precision = gazetteer.resolve(countries, postcodes, rows['location'].values)
+    resolved = ~np.isnan(lat)
+    return positions[resolved], lat[resolved], lng[resolved], precision[resolved]
+
+
+def geocode_df(df, country='de', provider=google_provider, workers=WORKERS, rate=RATE,
+               retries=RETRIES, backoff=BACKOFF, batch_size=BATCH_SIZE, gazetteer=None, level='street'):
+    has_country = df['country'].notnull().values
+    countries = df['country'].astype(object).where(df['country'].notnull(), country)
+    searches = get_searches(df)
+    keys = pd.DataFrame({'country': countries.values, 'search': searches.values,
+                         'has_country': has_country})
+    keys['key'] = [normalize_key(c, s) for c, s in zip(keys['country'], keys['search'])]
+    unique = keys.drop_duplicates('key')
+    found = load_cache(zip(unique['country'], unique['search']))
+    centroids = {}
+    if gazetteer is not None:
+        # Local centroids before paid lookups, they are not written to the cache
+        uncached = unique[~unique['key'].isin(list(found))]
+        positions, lat, lng, precision = gazetteer_lookup(df, uncached.index.values, uncached['country'].values,
+                                                          gazetteer, level=level)
+        found.update(zip(keys['key'].values[positions], zip(lat, lng)))
+        centroids.update(zip(keys['key'].values[positions], precision))
+    local = len(centroids)
+    misses = [(c, s, h) for c, s, h, key in unique.itertuples(index=False)
+              if key not in found and s]
+    print('%d rows, %d addresses, %d from the gazetteer, %d to geocode' % (len(df), len(unique), local,
+                                                                         len(misses)))
+
+    limiter = RateLimiter(rate)
+    progress = Progress(len(misses), label='geocoding', check=1)
+    rows = []
+
+    def keep(future):
+        c, search = futures[future]
+        latlng, geojson = future.result()
+        found[normalize_key(c, search)] = tuple(latlng)
+        rows.append((c, search, latlng[0], latlng[1], geojson))
+        progress.update()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_lookup, provider, limiter, search, country,
+                            c if h else None, retries, backoff): (c, search)
+            for c, search, h in misses
+        }
+        kept = set()
+        try:
+            for future in as_completed(futures):
+                kept.add(future)
+                keep(future)
+                if len(rows) >= batch_size:
+                    _write_batch(rows)
+        except BaseException:
+            # Any failure or an interrupt stops the queued lookups, the running ones are paid for
+            # and still go to the cache
+            for future in futures:
+                future.cancel()
+            for future in as_completed(f for f in futures if not f.cancelled() and f not in kept):
+                if future.exception() is None:
+                    keep(future)
+            raise
+        finally:
+            _write_batch(rows)
+
+    latlng = [found.get(key, (None, None)) for key in keys['key']]
+    df = df.copy()
+    df['lat'] = np.array([x[0] for x in latlng], dtype=float)
+    df['lng'] = np.array([x[1] for x in latlng], dtype=float)
+    precision = [centroids.get(key, GEOCODED) for key in keys['key']]
+    df['geo_precision'] = pd.Series(precision, index=df.index, dtype=object).where(df['lat'].notnull(), None)
+    return df
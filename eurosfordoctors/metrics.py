@@ -0,0 +1,271 @@
+import collections
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Windows, memory comes from psutil there if it is installed
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 10.0
+# Rows between clock reads, progress costs one increment per row otherwise
+PROGRESS_CHECK = 1000
+SAMPLE_INTERVAL = 0.005
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process (or a child) so far, None where it can't be measured
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        scale = 2 ** 20 if sys.platform == 'darwin' else 2 ** 10
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max(own, children) / float(scale)
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / float(2 ** 20)
+    return None
+
+
+def rss_mb():
+    # Current resident memory of the process, None where it can't be measured
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / float(2 ** 20)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / float(2 ** 20)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Metrics(object):
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+
+    def add(self, name, seconds, rows=None, calls=1, rss=None, rss_delta=None, process_peak=None):
+        # rss_mb: the most memory in use at the end of a call, rss_delta_mb: growth over all calls,
+        # process_peak_rss_mb: the peak of the whole process so far, it includes earlier stages
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'rss_mb': 0.0,
+                                              'rss_delta_mb': 0.0, 'process_peak_rss_mb': 0.0})
+        stage['calls'] += calls
+        stage['seconds'] += seconds
+        stage['rows'] += rows or 0
+        stage['rss_mb'] = max(stage['rss_mb'], rss or 0.0)
+        stage['rss_delta_mb'] += rss_delta or 0.0
+        stage['process_peak_rss_mb'] = max(stage['process_peak_rss_mb'], process_peak or 0.0)
+
+    def merge(self, stages):
+        # Stages recorded in another process
+        for name, stage in stages.items():
+            self.add(name, stage['seconds'], rows=stage['rows'], calls=stage['calls'], rss=stage['rss_mb'],
+                     rss_delta=stage['rss_delta_mb'], process_peak=stage['process_peak_rss_mb'])
+
+    def report(self):
+        report = collections.OrderedDict()
+        for name, stage in self.stages.items():
+            stage = dict(stage)
+            stage['rows_per_second'] = stage['rows'] / stage['seconds'] if stage['seconds'] else None
+            report[name] = stage
+        return report
+
+    def log(self):
+        for name, stage in self.report().items():
+            logger.info('%-24s %4d calls %9.2fs %9d rows %10s rows/s %8.1f MB %+8.1f MB', name, stage['calls'],
+                        stage['seconds'], stage['rows'],
+                        '%.0f' % stage['rows_per_second'] if stage['rows_per_second'] is not None else '-',
+                        stage['rss_mb'], stage['rss_delta_mb'])
+
+    def clear(self):
+        self.stages.clear()
+
+
+METRICS = Metrics()
+_collectors = [METRICS]
+
+
+def current():
+    return _collectors[-1]
+
+
+@contextmanager
+def collect():
+    # Records stages into a fresh Metrics, e.g. in a worker process whose results are merged later
+    metrics = Metrics()
+    _collectors.append(metrics)
+    try:
+        yield metrics
+    finally:
+        _collectors.remove(metrics)
+
+
+@contextmanager
+def stage(name, rows=None):
+    # Set info['rows'] inside the block when the row count is only known at the end
+    info = {'rows': rows}
+    start_rss = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start
+        rss = rss_mb()
+        current().add(name, seconds, rows=info['rows'], rss=rss,
+                      rss_delta=rss - start_rss if rss is not None and start_rss is not None else None,
+                      process_peak=peak_rss_mb())
+
+
+def timed(name=None):
+    # Decorator for functions taking a frame first, its length counts as rows
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            rows = len(args[0]) if args and hasattr(args[0], '__len__') else None
+            with stage(label, rows=rows):
+                return func(*args, **kwargs)
+        return inner
+    return decorator
+
+
+class Progress(object):
+    # Logs at most every interval seconds, the clock is only read every check rows
+    def __init__(self, total=None, label='progress', interval=PROGRESS_INTERVAL, check=PROGRESS_CHECK):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.check = check
+        self.count = 0
+        self.start = self.last = time.perf_counter()
+        self.next_check = check
+
+    def update(self, n=1):
+        self.count += n
+        if self.count < self.next_check:
+            return
+        self.next_check = self.count + self.check
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.log(now)
+
+    def log(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        rate = self.count / elapsed if elapsed else 0.0
+        if self.total:
+            logger.info('%s: %d/%d (%.0f%%) %.0f/s', self.label, self.count, self.total,
+                        100.0 * self.count / self.total, rate)
+        else:
+            logger.info('%s: %d %.0f/s', self.label, self.count, rate)
+
+    def done(self):
+        self.log()
+
+
+def progress_apply(obj, func, *args, **kwargs):
+    progress = Progress(len(obj), label=kwargs.pop('label', getattr(func, '__name__', 'apply')))
+
+    def wrapper(*a, **kw):
+        progress.update()
+        return func(*a, **kw)
+    result = obj.apply(wrapper, *args, **kwargs)
+    progress.done()
+    return result
+
+
+class SamplingProfiler(object):
+    # Samples the stack of one thread from a background thread and counts package functions
+    def __init__(self, interval=SAMPLE_INTERVAL, thread_id=None, package_dir=PACKAGE_DIR):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.package_dir = package_dir
+        self.own = collections.Counter()
+        self.total = collections.Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        seen = set()
+        innermost = True
+        while frame is not None:
+            code = frame.f_code
+            if code.co_filename.startswith(self.package_dir) and not code.co_filename.endswith('metrics.py'):
+                name = getattr(code, 'co_qualname', code.co_name)
+                key = '%s:%s' % (os.path.basename(code.co_filename)[:-3], name)
+                if innermost:
+                    self.own[key] += 1
+                    innermost = False
+                if key not in seen:
+                    self.total[key] += 1
+                    seen.add(key)
+            frame = frame.f_back
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def top(self, n=20):
+        # own: innermost package function including the library calls it makes,
+        # total: anywhere on the stack
+        samples = float(self.samples or 1)
+        return [{'function': key, 'own': count / samples, 'total': self.total[key] / samples}
+                for key, count in self.own.most_common(n)]
+
+    def log(self, n=20):
+        for row in self.top(n):
+            logger.info('%-40s own %5.1f%% total %5.1f%%', row['function'], 100 * row['own'], 100 * row['total'])
+
+
+def write_metrics(filename, metrics=METRICS, profiler=None, **extra):
+    # The latest run goes to filename, every run is appended to the .jsonl history next to it
+    record = collections.OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                                      ('peak_rss_mb', peak_rss_mb())])
+    record.update(extra)
+    record['stages'] = metrics.report()
+    if profiler is not None:
+        record['profile'] = profiler.top()
+    with open(filename, 'w') as f:
+        json.dump(record, f, indent=2)
+    with open('%s.jsonl' % os.path.splitext(filename)[0], 'a') as f:
+        f.write(json.dumps(record))
+        f.write('\n')
+    return record
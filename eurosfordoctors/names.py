@@ -0,0 +1,172 @@
+import re
+import time
+from collections import namedtuple
+from functools import lru_cache
+
+from slugify import slugify
+
+from .fixers import (TITLES, MALE_GENDER, FEMALE_GENDER, MULTI_SPACE, NAME_DASH_SPACE, CLEAN_NAME,
+                     apply_name_fixes, get_titles as regex_titles, is_upper)
+
+
+CACHE_SIZE = 2 ** 18
+
+# The words of the anchored title regex, in the order the regex tries them
+TITLE_WORDS = ('Docteur', 'Dottoressa', 'Professor', 'Professeur', 'Egregio', 'Chairman', 'Chairwoman',
+               'Dott', 'Dr', 'Prof', 'Univ', 'Prim', 'Ass', 'Assoc', 'Priv', 'Doz', 'Mag', 'MBA', 'MSc',
+               'stom', 'nat', 'dent', 'univers', 'habil', 'med', 'dipl', 'priv', 'doz', 'oec', 'troph',
+               'lic', 'phil', 'pract')
+TITLE_SEPARATORS = '-‐'
+# Names the trie does not cover: the other title regexes could match, or
+# characters that case fold to ASCII letters under re.I
+FALLBACK = re.compile('dip|apotheker|[İıſK]', re.I)
+FALLBACK_CASE = re.compile('(?:PD|MD|OA)\\s|%s' % TITLES[2].pattern)
+
+ParsedName = namedtuple('ParsedName', 'title first_name last_name name clean_name gender')
+
+
+def _lower(c):
+    return c.lower() if 'A' <= c <= 'Z' else c
+
+
+def _is_separator(c):
+    return c.isspace() or c in TITLE_SEPARATORS
+
+
+def _is_letter(c):
+    return 'a' <= _lower(c) <= 'z'
+
+
+class TitleTrie(object):
+    def __init__(self, words=TITLE_WORDS):
+        self.root = {}
+        for order, word in enumerate(words):
+            node = self.root
+            for c in word.lower():
+                node = node.setdefault(c, {})
+            node.setdefault(None, order)
+
+    def words_at(self, s, pos):
+        # (order, end) of every title word starting at pos
+        found = []
+        node = self.root
+        for i in range(pos, len(s)):
+            node = node.get(_lower(s[i]))
+            if node is None:
+                break
+            if None in node:
+                found.append((node[None], i + 1))
+        found.sort()
+        return [end for order, end in found]
+
+    def match(self, s, pos=0):
+        # Same backtracking order as (?:(?:words)\.?[-\s]*)+(?![a-z]) with re.I
+        for end in self.words_at(s, pos):
+            dots = [end + 1, end] if end < len(s) and s[end] == '.' else [end]
+            for start in dots:
+                stop = start
+                while stop < len(s) and _is_separator(s[stop]):
+                    stop += 1
+                for e in range(stop, start - 1, -1):
+                    longer = self.match(s, e)
+                    if longer is not None:
+                        return longer
+                    if e == len(s) or not _is_letter(s[e]):
+                        return e
+        return None
+
+
+class NameParser(object):
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.trie = TitleTrie()
+        self.trie_calls = 0
+        self.regex_calls = 0
+        self.seconds = 0.0
+        self.calls = 0
+        self._titles = lru_cache(maxsize=cache_size)(self._get_titles)
+        self._parse = lru_cache(maxsize=cache_size)(self._parse_name)
+
+    def _fast_titles(self, name):
+        if not name or name[0].isspace() or FALLBACK.search(name) or FALLBACK_CASE.search(name):
+            return None
+        end = self.trie.match(name) or 0
+        match, rest = name[:end], name[end:].strip()
+        # A dot left over could start a Dr./Prof./-Ing. title further in
+        if '.' in rest or any(c in TITLE_SEPARATORS for c in match):
+            return None
+        if not end:
+            return None, name
+        title = match.strip().replace('/ ', '/')
+        return title, rest or name.strip()
+
+    def _get_titles(self, name):
+        result = self._fast_titles(name)
+        if result is None:
+            self.regex_calls += 1
+            return regex_titles(name)
+        self.trie_calls += 1
+        return result
+
+    def get_titles(self, name):
+        start = time.perf_counter()
+        result = self._titles(name)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        return result
+
+    def _parse_name(self, name):
+        name = apply_name_fixes(name)
+        gender = None
+        if MALE_GENDER.search(name) is not None:
+            name = MALE_GENDER.sub('', name).strip()
+            gender = 'Herr'
+        if FEMALE_GENDER.search(name) is not None:
+            name = FEMALE_GENDER.sub('', name).strip()
+            gender = 'Frau'
+        # Not through the titles cache, its stats count get_titles calls only
+        title, name = self._get_titles(name)
+        if is_upper(name) and len(name) > 4:
+            name = name.title()
+
+        parts = list(reversed(name.split(','))) if ',' in name else name.rsplit(' ', 1)
+        parts = [MULTI_SPACE.sub(' ', x) for x in parts]
+        parts = [n.title() if is_upper(n) else n for n in parts]
+        name = NAME_DASH_SPACE.sub('', ' '.join(parts).strip())
+        first_name = NAME_DASH_SPACE.sub('', ' '.join(parts[:-1]).strip())
+        last_name = NAME_DASH_SPACE.sub('', parts[-1].strip())
+        name = MULTI_SPACE.sub(' ', name)
+        clean_name = slugify(CLEAN_NAME.sub('\\1 \\2', name).lower())
+        return ParsedName(title, first_name, last_name, name, clean_name, gender)
+
+    def parse_name(self, name):
+        # Raw hcp name to its parts, for companies with the usual name order
+        start = time.perf_counter()
+        result = self._parse(name)
+        self.seconds += time.perf_counter() - start
+        self.calls += 1
+        return result
+
+    def stats(self):
+        # Each get_titles and parse_name call is one lookup in its own cache
+        titles, parsed = self._titles.cache_info(), self._parse.cache_info()
+        hits = titles.hits + parsed.hits
+        lookups = hits + titles.misses + parsed.misses
+        return {
+            'calls': self.calls,
+            'hit_rate': hits / float(lookups) if lookups else 0.0,
+            'trie': self.trie_calls,
+            'regex': self.regex_calls,
+            'seconds': self.seconds,
+            'us_per_call': 1e6 * self.seconds / self.calls if self.calls else 0.0,
+        }
+
+    def clear(self):
+        self._titles.cache_clear()
+        self._parse.cache_clear()
+        self.trie_calls = self.regex_calls = self.calls = 0
+        self.seconds = 0.0
+
+
+PARSER = NameParser()
+get_titles = PARSER.get_titles
+parse_name = PARSER.parse_name
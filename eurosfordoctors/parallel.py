@@ -0,0 +1,91 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from slugify import slugify
+
+from .blocking import candidate_pairs, link_pairs
+from .dedupe import compare_rows
+
+
+COMPARE_FIELDS = ['type', 'company', 'name', 'first_name', 'last_name', 'recipient_detail',
+                  'address', 'location', 'lat', 'lng']
+CHUNK_SIZE = 20000
+
+
+def shard_keys(df):
+    # Shard by type and the first letter of the name key
+    name = df['last_name'] if 'last_name' in df else df['name']
+    name = name.where(name.notnull() & (df['type'] == 'hcp'), df['name'])
+    initials = {v: slugify(v)[:1] for v in name.dropna().unique()}
+    return (df['type'].astype(str) + ':' + name.map(initials).fillna('')).values
+
+
+def make_tasks(df, pairs, chunk_size=CHUNK_SIZE):
+    keys = shard_keys(df)[pairs[:, 0]] if len(pairs) else np.array([], dtype=object)
+    tasks = []
+    for key in sorted(set(keys)):
+        shard = pairs[keys == key]
+        for start in range(0, len(shard), chunk_size):
+            tasks.append(shard[start:start + chunk_size])
+    return tasks
+
+
+def _compare_task(records, pairs, cmp):
+    return [(i, j) for i, j in pairs if cmp(records[i], records[j])]
+
+
+def _task_records(records, pairs):
+    return {pos: records[pos] for pos in np.unique(pairs)}
+
+
+def compare_parallel(df, pairs, cmp=compare_rows, jobs=None, chunk_size=CHUNK_SIZE):
+    columns = [c for c in COMPARE_FIELDS if c in df]
+    records = df[columns].to_dict('records')
+    tasks = make_tasks(df, pairs, chunk_size=chunk_size)
+    jobs = jobs or os.cpu_count() or 1
+
+    matched = []
+    if jobs == 1:
+        for task in tasks:
+            matched.extend(_compare_task(records, task.tolist(), cmp))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(_compare_task, _task_records(records, task), task.tolist(), cmp)
+                       for task in tasks]
+            for future in futures:
+                matched.extend(future.result())
+    matched = np.array(sorted(matched), dtype=np.int64).reshape(-1, 2)
+    return matched
+
+
+def link_parallel(df, cmp=compare_rows, pairs=None, jobs=None, field='uid'):
+    if pairs is None:
+        pairs = candidate_pairs(df)
+    matched = compare_parallel(df, pairs, cmp=cmp, jobs=jobs)
+    # Union-find over sorted pairs, the uids do not depend on scheduling
+    return link_pairs(df, matched, field=field)
+
+
+def benchmark(df, jobs=(1, 2, 4), cmp=compare_rows):
+    pairs = candidate_pairs(df)
+    results = []
+    reference = None
+    for n in jobs:
+        start = time.time()
+        linked = link_parallel(df.copy(), cmp=cmp, pairs=pairs, jobs=n)
+        duration = time.time() - start
+        if reference is None:
+            reference = linked['uid'].values
+        results.append({
+            'jobs': n,
+            'pairs': len(pairs),
+            'seconds': duration,
+            'speedup': results[0]['seconds'] / duration if results else 1.0,
+            'same_result': bool((linked['uid'].values == reference).all()),
+        })
+        print('%d jobs: %.2fs' % (n, duration))
+    return pd.DataFrame(results)
@@ -0,0 +1,73 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from .schema import apply_schema, restore, to_parquet
+from .utils import AMOUNT_FIELDS, MONEY_FIELDS_ONLY
+
+LABEL_FIELDS = ['company', 'currency', 'type', 'year', 'recipient_detail']
+PAYMENT_COLUMNS = ['uid'] + LABEL_FIELDS + ['label', 'amount']
+
+
+def make_payments_table(df):
+    # One row per uid and positive amount, field by field and in row order like melting
+    df = df[df['uid'].notnull()]
+    labels = [df[f].to_numpy(dtype=object) for f in LABEL_FIELDS]
+    uids = df['uid'].to_numpy(dtype=object)
+    frames = []
+    for field in AMOUNT_FIELDS:
+        amount = df[field]
+        keep = (amount.notnull() & (amount > 0)).values
+        frame = pd.DataFrame({f: values[keep] for f, values in zip(LABEL_FIELDS, labels)}, dtype=object)
+        frame.insert(0, 'uid', uids[keep])
+        frame['label'] = field
+        frame['amount'] = amount.values[keep]
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+
+def decode_payments(payments, ids):
+    # All JSON cells in one json.loads instead of one parse and DataFrame per row
+    cells = ['[]' if pd.isnull(p) or not p else p for p in payments]
+    decoded = json.loads('[%s]' % ','.join(cells))
+    counts = np.array([len(d) for d in decoded], dtype=np.int64)
+    records = [p for d in decoded for p in d]
+    table = pd.DataFrame.from_records(records, columns=[c for c in PAYMENT_COLUMNS if c != 'uid'])
+    table.insert(0, 'uid', np.repeat(np.asarray(ids, dtype=object), counts))
+    return table
+
+
+def pivot_totals(table, index=None):
+    # Per uid and label sums plus computed_total, like utils.unpack_json for every entity at once
+    amount = pd.to_numeric(table['amount'], errors='coerce')
+    totals = amount.groupby([table['uid'].values, table['label'].values]).sum().unstack(fill_value=0.0)
+    totals = totals.reindex(columns=MONEY_FIELDS_ONLY, fill_value=0.0)
+    totals['computed_total'] = totals.sum(axis=1)
+    if index is not None:
+        totals = totals.reindex(index)
+    return totals
+
+
+def unpack_payments(entities, id_column='uid'):
+    # Vectorized entities.apply(utils.unpack_json, axis=1)
+    entities = entities.copy()
+    ids = entities[id_column] if id_column in entities else pd.Series(entities.index, index=entities.index)
+    table = decode_payments(entities['payments'], ids)
+    totals = pivot_totals(table, index=ids.values)
+    for column in totals.columns:
+        entities[column] = totals[column].values
+    return entities
+
+
+def write_payments(table, filename):
+    # Amounts as integer cents, the label columns as categories
+    to_parquet(apply_schema(table, money='cents'), filename)
+
+
+def read_payments(filename):
+    return restore(pd.read_parquet(filename))
+
+
+def load_totals(filename, index=None):
+    return pivot_totals(read_payments(filename), index=index)
@@ -0,0 +1,429 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from . import columnar, fixers, metrics, rules
+from .blocking import candidate_pairs, link_pairs, pairs_touching
+from .schema import to_parquet, write_parquet
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNTRY = 'PL'
+DEFAULT_YEAR = 2015
+
+STAGES = ('clean', 'dedupe', 'geocode', 'entities')
+# Changing any of these modules invalidates the cleaned cache
+CODE_MODULES = ('fixers', 'names', 'rules', 'columnar', 'pipeline')
+MANIFEST = 'manifest.json'
+RECORD_KEY = 'record_key'
+# Files above LARGE_FILE bytes are read and cleaned CHUNK_ROWS rows at a time
+LARGE_FILE = 256 * 2 ** 20
+CHUNK_ROWS = 200000
+
+SETTINGS_LISTS = rules.FLAGS
+
+
+def make_settings(config):
+    settings = config.get('settings', {})
+    unknown = set(settings) - set(SETTINGS_LISTS) - {'address_rules'}
+    if unknown:
+        raise ValueError('Unknown settings: %s' % ', '.join(sorted(unknown)))
+    company_settings = {key: list(settings.get(key, [])) for key in SETTINGS_LISTS}
+    address_rules = {}
+    for company, spec in settings.get('address_rules', {}).items():
+        try:
+            address_rules[company] = rules.make_rule(spec)
+        except (TypeError, ValueError, re.error) as e:
+            raise ValueError('Bad address rule for %s: %s' % (company, e))
+    company_settings['address_rules'] = address_rules
+    return company_settings
+
+
+def _config_path(base, path):
+    if path is None or os.path.isabs(path):
+        return path
+    return os.path.normpath(os.path.join(base, path))
+
+
+def load_config(filename):
+    with open(filename) as f:
+        config = json.load(f)
+    country = config.get('country', DEFAULT_COUNTRY)
+    # Paths in a config file are relative to the file, the defaults to the working directory
+    base = os.path.dirname(os.path.abspath(filename))
+    return {
+        'country': country,
+        'year': config.get('year', DEFAULT_YEAR),
+        'raw_dir': _config_path(base, config.get('raw_dir')) or os.path.join('data', country.lower(), 'raw_csv'),
+        'cache_dir': _config_path(base, config.get('cache_dir')) or os.path.join('data', country.lower(), 'cache'),
+        'output': _config_path(base, config.get('output')),
+        'gazetteer': _config_path(base, config.get('gazetteer')),
+        'geocode_level': config.get('geocode_level', 'street'),
+        'settings': make_settings(config),
+    }
+
+
+def read_raw(filename, chunksize=None):
+    return pd.read_csv(filename, encoding='utf-8', escapechar='\\', converters={'postcode': str, 'uci': str},
+                       na_values=['-'], chunksize=chunksize)
+
+
+def clean_frame(df, company, settings, country=DEFAULT_COUNTRY, year=DEFAULT_YEAR):
+    # Drop everything with empty name -> useless
+    if df['name'].isnull().sum() != 0:
+        logger.info('%d null names!', df['name'].isnull().sum())
+    df = df[df['name'].notnull()]
+
+    df['type'] = df['type'].str.lower()
+    bad_type = ~df['type'].isin(['hcp', 'hco'])
+    if bad_type.any():
+        raise ValueError('%s: %d rows with a type other than hcp or hco: %s' % (
+            company, bad_type.sum(), ', '.join(sorted(df.loc[bad_type, 'type'].astype(str).unique()))))
+
+    if 'country' not in df:
+        df['country'] = None
+    df['recipient_detail'] = None
+    df['base_country'] = country
+    df['origin'] = country
+    df['year'] = year
+    df['company'] = company
+    with metrics.stage('make_money', rows=len(df)):
+        df = fixers.make_money(df)
+    with metrics.stage('fix_name', rows=len(df)):
+        df = columnar.fix_name(df, settings)
+    with metrics.stage('split_name', rows=len(df)):
+        df = columnar.split_name(df, settings)
+    with metrics.stage('fix_address', rows=len(df)):
+        df = columnar.fix_address(df, settings)
+    df['country'] = df['country'].apply(lambda x: fixers.fix_country(x, default=country))
+    if 'postcode' in df:
+        df['postcode'] = df['postcode'].apply(lambda x: np.nan if pd.notnull(x) and not x else x)
+    else:
+        df['postcode'] = np.nan
+
+    df['uid'] = None
+
+    if 'gender' not in df:
+        df['gender'] = np.nan
+    return df
+
+
+def load_dataframe(filename, settings, country=DEFAULT_COUNTRY, year=DEFAULT_YEAR, cleaned_dir=None,
+                   chunksize=None):
+    logger.info(filename)
+    basename = os.path.basename(filename)
+    basename = basename.split('.')[0]
+    company = basename.split('_')[0]
+    if chunksize is None and os.path.getsize(filename) > LARGE_FILE:
+        chunksize = CHUNK_ROWS
+    if chunksize is None:
+        with metrics.stage('read_csv') as info:
+            df = read_raw(filename)
+            info['rows'] = len(df)
+        df = clean_frame(df, company, settings, country=country, year=year)
+    else:
+        # Cleaning is row by row, large files are cleaned a chunk at a time
+        df = concat_frames([clean_frame(chunk, company, settings, country=country, year=year)
+                            for chunk in read_raw(filename, chunksize=chunksize)])
+
+    if cleaned_dir is not None:
+        clean_name = os.path.join(cleaned_dir, '%s_cleaned.csv' % basename)
+        df.to_csv(clean_name, index=False, encoding='utf-8')
+    return df
+
+
+def clean_file(filename, settings, country=DEFAULT_COUNTRY, year=DEFAULT_YEAR, chunksize=None):
+    # Stage metrics are returned with the frame, workers can't record into the parent's
+    start = time.time()
+    with metrics.collect() as collected:
+        df = load_dataframe(filename, settings, country=country, year=year, chunksize=chunksize)
+        df[RECORD_KEY] = record_keys(df)
+    return df, time.time() - start, collected.stages
+
+
+def load_files(filenames, settings, country=DEFAULT_COUNTRY, year=DEFAULT_YEAR, jobs=None, chunksize=None):
+    jobs = min(jobs or os.cpu_count() or 1, len(filenames))
+    if jobs <= 1:
+        results = [clean_file(f, settings, country=country, year=year, chunksize=chunksize)
+                   for f in filenames]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(clean_file, f, settings, country=country, year=year,
+                                       chunksize=chunksize) for f in filenames]
+            results = [future.result() for future in futures]
+    frames = []
+    for filename, (df, duration, stages) in zip(filenames, results):
+        metrics.current().merge(stages)
+        logger.info('%s: %d rows in %.2fs (%.0f rows/s)', os.path.basename(filename), len(df), duration,
+                    len(df) / duration if duration else 0)
+        frames.append(df)
+    return frames
+
+
+def concat_frames(frames):
+    frames = [f for f in frames if len(f.columns)]
+    if not frames:
+        return pd.DataFrame()
+    columns = []
+    for frame in frames:
+        columns.extend(c for c in frame.columns if c not in columns)
+    # Files where a column is empty or typed differently would otherwise
+    # decide the combined dtype, use the dtype of the files with values
+    for column in columns:
+        dtypes = {f[column].dtype for f in frames if column in f and f[column].notnull().any()}
+        if all(pd.api.types.is_numeric_dtype(d) for d in dtypes):
+            continue
+        target = dtypes.pop() if len(dtypes) == 1 else object
+        for frame in frames:
+            if column in frame and frame[column].dtype != target:
+                frame[column] = frame[column].astype(target)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def _sha1(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode('utf-8'))
+    return h.hexdigest()
+
+
+def file_fingerprint(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _describe(obj):
+    if callable(obj):
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            code = getattr(obj, '__code__', None)
+            source = repr((code.co_code, code.co_consts)) if code is not None else repr(obj)
+        return '%s:%s' % (getattr(obj, '__qualname__', repr(obj)), _sha1(source))
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return repr(obj)
+
+
+def settings_fingerprint(settings):
+    return _sha1(json.dumps(settings, sort_keys=True, default=_describe))
+
+
+def code_fingerprint(modules=CODE_MODULES):
+    package = sys.modules[__package__]
+    sources = []
+    for name in modules:
+        path = os.path.join(os.path.dirname(package.__file__), '%s.py' % name)
+        with open(path, 'rb') as f:
+            sources.append(f.read())
+    return _sha1(*sources)
+
+
+def record_keys(df, columns=None):
+    # Content hash per record, repeated identical records are counted apart
+    columns = [c for c in (columns or df.columns) if c not in ('uid', RECORD_KEY)]
+    hashes = pd.util.hash_pandas_object(df[columns].astype(object).astype(str), index=False)
+    occurrence = hashes.groupby(hashes.values).cumcount()
+    return ['%016x-%d' % (h, i) for h, i in zip(hashes.values, occurrence.values)]
+
+
+class Pipeline(object):
+    def __init__(self, raw_dir, cache_dir, settings, country=DEFAULT_COUNTRY, year=DEFAULT_YEAR, jobs=None,
+                 provider=None, rate=None, gazetteer=None, geocode_level='street'):
+        self.raw_dir = raw_dir
+        self.cache_dir = cache_dir
+        self.settings = settings
+        self.country = country
+        self.year = year
+        self.jobs = jobs
+        # Geocoding provider and requests per second, geocode.google_provider and geocode.RATE unless given
+        self.provider = provider
+        self.rate = rate
+        # A Gazetteer or the file to load one from, see gazetteer.Gazetteer.load
+        self.gazetteer = gazetteer
+        self.geocode_level = geocode_level
+        self.new = None
+        os.makedirs(os.path.join(cache_dir, 'cleaned'), exist_ok=True)
+        self.manifest_path = os.path.join(cache_dir, MANIFEST)
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {'files': {}}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def save_manifest(self):
+        with open(self.manifest_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def version(self):
+        return _sha1(settings_fingerprint(self.settings), code_fingerprint(),
+                     repr((self.country, self.year)))
+
+    def raw_files(self):
+        return sorted(glob(os.path.join(self.raw_dir, '*.csv')))
+
+    def clean(self):
+        filenames = self.raw_files()
+        if not filenames:
+            raise ValueError('No raw CSV files in %s' % os.path.abspath(self.raw_dir))
+        version = self.version()
+        files = self.manifest['files']
+        frames = {}
+        stale = {}
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            fingerprint = _sha1(file_fingerprint(filename), version)
+            entry = files.get(basename)
+            if entry is not None and entry['fingerprint'] == fingerprint and os.path.exists(self.parquet(basename)):
+                logger.info('%s unchanged, %d cached rows', basename, entry['rows'])
+                frames[filename] = pd.read_parquet(self.parquet(basename))
+            else:
+                stale[filename] = fingerprint
+        changed = list(stale)
+        for filename, df in zip(changed, load_files(changed, self.settings, country=self.country,
+                                                    year=self.year, jobs=self.jobs)):
+            basename = os.path.basename(filename)
+            to_parquet(df, self.parquet(basename))
+            files[basename] = {'fingerprint': stale[filename], 'rows': len(df)}
+            frames[filename] = df
+        for basename in set(files) - {os.path.basename(f) for f in frames}:
+            logger.info('%s removed', basename)
+            del files[basename]
+        self.save_manifest()
+        return concat_frames([frames[f] for f in sorted(frames)])
+
+    def parquet(self, basename):
+        return self.path(os.path.join('cleaned', '%s.parquet' % basename.split('.')[0]))
+
+    def previous_uids(self):
+        linked = self.path('linked.parquet')
+        if not os.path.exists(linked):
+            return {}
+        linked = pd.read_parquet(linked)
+        return dict(zip(linked[RECORD_KEY], linked['uid']))
+
+    def save_uids(self, df):
+        to_parquet(df[[RECORD_KEY, 'uid']], self.path('linked.parquet'))
+
+    def dedupe(self, df):
+        from .parallel import compare_parallel
+
+        df['uid'] = df[RECORD_KEY].map(self.previous_uids()).astype(object)
+        new = df['uid'].isnull().values
+        # Only pairs with a new or changed record are compared, known records keep their uid
+        with metrics.stage('candidate_pairs', rows=len(df)):
+            pairs = pairs_touching(candidate_pairs(df), new)
+        logger.info('%d new records, %d candidate pairs', new.sum(), len(pairs))
+        with metrics.stage('compare_pairs', rows=len(pairs)):
+            matched = compare_parallel(df, pairs, jobs=self.jobs)
+
+        # New entities get uids derived from their record key
+        index = df.index
+        df.index = pd.Index(df[RECORD_KEY].values)
+        with metrics.stage('link_pairs', rows=len(matched)):
+            df = link_pairs(df, matched)
+        df.index = index
+        self.new = new
+        return df
+
+    def load_gazetteer(self):
+        if not isinstance(self.gazetteer, str):
+            return self.gazetteer
+        from .gazetteer import Gazetteer
+
+        with metrics.stage('load_gazetteer') as info:
+            gazetteer = Gazetteer.load(self.gazetteer)
+            info['rows'] = len(gazetteer)
+        return gazetteer
+
+    def geocode(self, df):
+        from . import dedupe, geocode
+
+        gazetteer = self.load_gazetteer()
+        with metrics.stage('geocode_df', rows=len(df)):
+            df = geocode.geocode_df(df, country=self.country.lower(),
+                                    provider=self.provider or geocode.google_provider,
+                                    rate=geocode.RATE if self.rate is None else self.rate,
+                                    gazetteer=gazetteer, level=self.geocode_level)
+        with metrics.stage('fill_postcodes', rows=len(df)):
+            df = geocode.fill_postcodes(df, gazetteer=gazetteer)
+        df['uid_original'] = df['uid'].copy()
+        index = df.index
+        df.index = pd.Index(df[RECORD_KEY].values)
+        with metrics.stage('link_geocoded', rows=len(df)):
+            df = dedupe.link_geocoded(df, new=self.new)
+        df.index = index
+        write_parquet(df, self.path('geocoded.parquet'))
+        return df
+
+    def entities(self, df):
+        from . import export, payments
+
+        with metrics.stage('payments', rows=len(df)):
+            payments.write_payments(payments.make_payments_table(df), self.path('payments.parquet'))
+        with metrics.stage('make_entities', rows=len(df)):
+            entities = export.make_entities_fast(df)
+        slugs = self.path('slugs.json')
+        previous = None
+        if os.path.exists(slugs):
+            with open(slugs) as f:
+                previous = json.load(f)
+        with metrics.stage('make_slugs', rows=len(entities)):
+            entities = export.make_slugs(entities, previous=previous)
+        with open(slugs, 'w') as f:
+            json.dump(export.previous_slugs(entities), f)
+        return entities
+
+    def run(self, stages=STAGES, profile=False, metrics_file=None):
+        # Stage timings go to metrics.json in the cache dir, with a sampled profile if asked for
+        profiler = metrics.SamplingProfiler().start() if profile else None
+        try:
+            with metrics.collect() as collected:
+                df = self._run(stages)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        collected.log()
+        if profiler is not None:
+            profiler.log()
+        metrics.write_metrics(metrics_file or self.path('metrics.json'), collected, profiler=profiler,
+                              stages_run=list(stages), rows=len(df), country=self.country, year=self.year,
+                              jobs=self.jobs)
+        return df
+
+    def _run(self, stages):
+        with metrics.stage('clean') as info:
+            df = self.clean()
+            info['rows'] = len(df)
+        logger.info('%d cleaned records', len(df))
+        if 'dedupe' in stages:
+            with metrics.stage('dedupe', rows=len(df)):
+                df = self.dedupe(df)
+                self.save_uids(df)
+        if 'geocode' in stages:
+            with metrics.stage('geocode', rows=len(df)):
+                df = self.geocode(df)
+                self.save_uids(df)
+        if 'entities' in stages:
+            with metrics.stage('entities', rows=len(df)):
+                return self.entities(df)
+        return df
@@ -0,0 +1,160 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from . import fixers
+
+
+# Company lists that switch a cleaning step on or off
+FLAGS = ('bad_name_order', 'comma_split_title', 'comma_split_title_name', 'semicolon_name_split',
+         'last_name_capitals', 'no_postcode', 'proper_postcode', 'no_pdf', 'hcp_company_in_address')
+
+Plan = namedtuple('Plan', 'flags address_rule')
+DEFAULT_PLAN = Plan(frozenset(), None)
+
+
+class SplitRule(object):
+    # Splits the address on sep into columns. Rows with fewer than min_parts parts (all columns unless
+    # given) are left alone, missing trailing columns become ''.
+    def __init__(self, columns, sep=',', right=True, min_parts=None):
+        self.columns = list(columns)
+        self.sep = sep
+        self.right = right
+        self.min_parts = len(self.columns) if min_parts is None else min_parts
+
+    def split(self, address):
+        n = len(self.columns) - 1
+        return address.rsplit(self.sep, n) if self.right else address.split(self.sep, n)
+
+    def __call__(self, address):
+        parts = self.split(address)
+        if len(parts) < self.min_parts:
+            return {}
+        parts = parts + [''] * (len(self.columns) - len(parts))
+        return dict(zip(self.columns, [p.strip() for p in parts]))
+
+    def apply(self, address):
+        n = len(self.columns) - 1
+        method = address.str.rsplit if self.right else address.str.split
+        parts = method(self.sep, n=n, expand=True)
+        parts = parts.reindex(columns=range(len(self.columns)))
+        complete = (parts.notnull().sum(axis=1) >= self.min_parts) & address.notnull()
+        parts = parts[complete].fillna('')
+        return {c: parts[i].astype(object).str.strip() for i, c in enumerate(self.columns)}
+
+    def __repr__(self):
+        return 'SplitRule(%r, sep=%r, right=%r, min_parts=%r)' % (self.columns, self.sep, self.right,
+                                                                  self.min_parts)
+
+
+class RegexRule(object):
+    # Named groups of a matching pattern become columns
+    def __init__(self, pattern, flags=0):
+        self.pattern = re.compile(pattern, flags)
+        if not self.pattern.groupindex:
+            raise ValueError('Address pattern needs named groups: %s' % self.pattern.pattern)
+        self.columns = list(self.pattern.groupindex)
+
+    def __call__(self, address):
+        match = self.pattern.match(address)
+        if match is None:
+            return {}
+        return {k: v.strip() for k, v in match.groupdict().items() if v is not None}
+
+    def apply(self, address):
+        matches = address.str.extract(self.pattern, expand=True)
+        return {c: matches[c].dropna().str.strip() for c in self.columns}
+
+    def __repr__(self):
+        return 'RegexRule(%r)' % self.pattern.pattern
+
+
+class CallbackRule(object):
+    # Any function from an address to a dict of columns, run once per row
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, address):
+        return self.func(address)
+
+    def apply(self, address):
+        results = []
+        for value in address:
+            try:
+                results.append(self.func(value))
+            except Exception:
+                print(value)
+                raise
+        columns = {}
+        for k in sorted(set(k for matches in results for k in matches)):
+            index = [i for i, matches in zip(address.index, results) if k in matches]
+            columns[k] = pd.Series([matches[k] for matches in results if k in matches],
+                                   index=index, dtype=object)
+        return columns
+
+    def __repr__(self):
+        return 'CallbackRule(%r)' % self.func
+
+
+# Declarative versions of the fixers.ADDRESS_PARSERS. Like the parser, two parts give an empty
+# country, a single part is left alone where the parser failed.
+NAMED_RULES = {
+    'address_location_country_comma': SplitRule(['address', 'location', 'country'], min_parts=2),
+}
+
+
+def make_rule(spec):
+    if isinstance(spec, (SplitRule, RegexRule, CallbackRule)):
+        return spec
+    if callable(spec):
+        return CallbackRule(spec)
+    if isinstance(spec, str):
+        if spec in NAMED_RULES:
+            return NAMED_RULES[spec]
+        if spec in fixers.ADDRESS_PARSERS:
+            return CallbackRule(fixers.ADDRESS_PARSERS[spec])
+        raise ValueError('Unknown address parser: %s' % spec)
+    if isinstance(spec, dict):
+        if 'split' in spec:
+            if not spec.get('columns'):
+                raise ValueError('Split rule needs columns: %r' % (spec,))
+            return SplitRule(spec['columns'], sep=spec['split'], right=spec.get('right', True),
+                             min_parts=spec.get('min_parts'))
+        if 'regex' in spec:
+            flags = re.I if spec.get('ignore_case') else 0
+            return RegexRule(spec['regex'], flags=flags)
+    raise ValueError('Unknown address rule: %r' % (spec,))
+
+
+class CompanyRules(object):
+    # COMPANY_SETTINGS compiled into one plan per company
+    def __init__(self, COMPANY_SETTINGS):
+        companies = {}
+        for key in FLAGS:
+            for company in COMPANY_SETTINGS.get(key, []):
+                companies.setdefault(company, set()).add(key)
+        address_rules = {company: make_rule(spec)
+                         for company, spec in COMPANY_SETTINGS.get('address_rules', {}).items()}
+        self.plans = {company: Plan(frozenset(companies.get(company, ())), address_rules.get(company))
+                      for company in set(companies) | set(address_rules)}
+
+    def plan(self, company):
+        return self.plans.get(company, DEFAULT_PLAN)
+
+    def flag(self, company, key):
+        # Boolean mask of rows whose company has the flag set, one lookup per distinct company
+        codes, uniques = pd.factorize(np.asarray(company, dtype=object))
+        flags = np.array([key in self.plan(c).flags for c in uniques] + [False])
+        return flags[codes]
+
+    def address_rules(self, company):
+        # (rule, mask) for each rule, companies sharing a rule are handled in one batch
+        codes, uniques = pd.factorize(np.asarray(company, dtype=object))
+        rules = {}
+        for code, c in enumerate(uniques):
+            rule = self.plan(c).address_rule
+            if rule is not None:
+                rules.setdefault(id(rule), (rule, []))[1].append(code)
+        return [(rule, np.isin(codes, group)) for rule, group in rules.values()]
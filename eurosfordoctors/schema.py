@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from .utils import MONEY_FIELDS, MONEY_FIELDS_ALL
+
+
+CATEGORY_FIELDS = ['company', 'type', 'country', 'origin', 'base_country', 'currency', 'year', 'label',
+                   'geo_precision']
+MONEY_COLUMNS = list(dict.fromkeys(MONEY_FIELDS + MONEY_FIELDS_ALL + ['amount']))
+DIRTY_SUFFIX = '_dirty'
+INT32_MAX = np.iinfo(np.int32).max
+
+
+def dirty_columns(df):
+    return [c for c in df.columns if c.endswith(DIRTY_SUFFIX)]
+
+
+def to_cents(series):
+    values = pd.to_numeric(series, errors='coerce')
+    cents = (values * 100).round()
+    # Int32 holds up to ~21 million in currency units, larger sums need Int64
+    dtype = 'Int32' if cents.abs().max(skipna=True) <= INT32_MAX or cents.isnull().all() else 'Int64'
+    return cents.astype(dtype)
+
+
+def compact_money(series, money='cents'):
+    # float32 is smaller but loses cents above ~131k, keep it for frames that are only summed
+    if money == 'cents':
+        return to_cents(series)
+    if money == 'float32':
+        return pd.to_numeric(series, errors='coerce').astype(np.float32)
+    raise ValueError('Unknown money representation: %s' % money)
+
+
+def apply_schema(df, money='cents', keep_dirty=True):
+    df = df.copy()
+    for column in CATEGORY_FIELDS:
+        if column in df:
+            df[column] = df[column].astype('category')
+    for column in MONEY_COLUMNS:
+        if column in df:
+            df[column] = compact_money(df[column], money=money)
+    if not keep_dirty:
+        df = df.drop(columns=dirty_columns(df))
+    return df
+
+
+def restore(df):
+    # Back to plain dtypes for the cleaning and dedupe code
+    df = df.copy()
+    for column in CATEGORY_FIELDS:
+        if column in df and isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(df[column].cat.categories.dtype)
+    for column in MONEY_COLUMNS:
+        if column not in df:
+            continue
+        if pd.api.types.is_integer_dtype(df[column]):
+            df[column] = df[column].astype('Float64').astype(np.float64) / 100
+        elif df[column].dtype == np.float32:
+            df[column] = df[column].astype(np.float64)
+    return df
+
+
+def to_parquet(df, filename):
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        # Arrow needs one type per column
+        if pd.api.types.infer_dtype(df[column], skipna=True) not in ('string', 'empty'):
+            df[column] = df[column].where(df[column].isnull(), df[column].astype(str))
+    df.to_parquet(filename, index=False)
+
+
+def dirty_filename(filename):
+    base, ext = os.path.splitext(filename)
+    return '%s%s%s' % (base, DIRTY_SUFFIX, ext)
+
+
+def write_parquet(df, filename, money='cents', keep_dirty=False):
+    # The raw money strings go to a side file in the same row order unless kept inline
+    dirty = dirty_columns(df)
+    if dirty and not keep_dirty:
+        to_parquet(df[dirty], dirty_filename(filename))
+    to_parquet(apply_schema(df, money=money, keep_dirty=keep_dirty), filename)
+
+
+def read_parquet(filename, dirty=False):
+    df = pd.read_parquet(filename)
+    side_filename = dirty_filename(filename)
+    if dirty and os.path.exists(side_filename):
+        side = pd.read_parquet(side_filename)
+        if len(side) != len(df):
+            raise ValueError('%s does not match %s' % (side_filename, filename))
+        df = pd.concat([df, side], axis=1)
+    return df
+
+
+def memory_report(before, after):
+    report = pd.DataFrame({
+        'before': before.memory_usage(deep=True, index=False),
+        'after': after.memory_usage(deep=True, index=False),
+    })
+    report['after'] = report['after'].fillna(0).astype(np.int64)
+    report['saved'] = 1 - report['after'] / report['before']
+    report.loc['total'] = [report['before'].sum(), report['after'].sum(),
+                           1 - report['after'].sum() / float(report['before'].sum())]
+    print('%.1f MB -> %.1f MB' % (report.loc['total', 'before'] / 2 ** 20, report.loc['total', 'after'] / 2 ** 20))
+    return report.sort_values('before', ascending=False)
@@ -0,0 +1,78 @@
+import difflib
+from collections import namedtuple
+from functools import lru_cache
+
+import pandas as pd
+import Levenshtein
+
+from fuzzywuzzy.utils import full_process
+
+
+CACHE_SIZE = 2 ** 20
+
+Prepared = namedtuple('Prepared', 'lower processed tokens')
+
+
+def _ratio(a, b):
+    # fuzzywuzzy.fuzz.ratio backed by python-Levenshtein
+    if a == b:
+        return 100
+    if not a or not b:
+        return 0
+    return int(round(100 * Levenshtein.ratio(a, b)))
+
+
+class Similarity(object):
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.prepared = {}
+        self.match = lru_cache(maxsize=cache_size)(self._match)
+
+    def prepare(self, val):
+        prepared = self.prepared.get(val)
+        if prepared is None:
+            processed = full_process(val, force_ascii=True)
+            prepared = Prepared(val.lower(), processed, frozenset(processed.split()))
+            self.prepared[val] = prepared
+        return prepared
+
+    def contains(self, a, b):
+        a, b = self.prepare(a).lower, self.prepare(b).lower
+        return a in b or b in a
+
+    def token_set_ratio(self, a, b):
+        # Same result as fuzz.token_set_ratio without reprocessing the strings
+        a, b = self.prepare(a), self.prepare(b)
+        if not a.processed or not b.processed:
+            return 0
+        sorted_sect = ' '.join(sorted(a.tokens & b.tokens))
+        combined_1to2 = (sorted_sect + ' ' + ' '.join(sorted(a.tokens - b.tokens))).strip()
+        combined_2to1 = (sorted_sect + ' ' + ' '.join(sorted(b.tokens - a.tokens))).strip()
+        return max(_ratio(sorted_sect, combined_1to2),
+                   _ratio(sorted_sect, combined_2to1),
+                   _ratio(combined_1to2, combined_2to1))
+
+    def fuzzy(self, a, b, threshold=0.9):
+        if self.token_set_ratio(a, b) / 100.0 >= threshold:
+            return True
+        # Levenshtein.ratio is an upper bound of SequenceMatcher.ratio,
+        # only run the slow matcher when it could still pass
+        if Levenshtein.ratio(a, b) < threshold:
+            return False
+        return difflib.SequenceMatcher(None, a, b).ratio() >= threshold
+
+    def _match(self, a, b, threshold=0.9):
+        if pd.isnull(a) or pd.isnull(b):
+            return False
+        return self.contains(a, b) or self.fuzzy(a, b, threshold=threshold)
+
+    def match_many(self, a, others, threshold=0.9):
+        if pd.isnull(a):
+            return [False] * len(others)
+        return [self.match(a, b, threshold) for b in others]
+
+    def clear(self):
+        self.prepared.clear()
+        self.match.cache_clear()
+
+
+SIMILARITY = Similarity()
@@ -0,0 +1,74 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+
+EARTH_RADIUS = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+MAX_LATITUDE = 85.0
+
+# Half of the 3x3 neighbourhood, the other half is covered from the other cell
+NEIGHBOUR_CELLS = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lng1, lat2, lng2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class GridIndex(object):
+    def __init__(self, lat, lng, radius=0.5):
+        lat = np.asarray(lat, dtype=float)
+        lng = np.asarray(lng, dtype=float)
+        valid = ~(np.isnan(lat) | np.isnan(lng))
+        self.radius = radius
+        self.positions = np.nonzero(valid)[0]
+        self.lat = lat[valid]
+        self.lng = lng[valid]
+
+        self.cell_lat = radius / KM_PER_DEGREE
+        max_lat = min(np.abs(self.lat).max() if len(self.lat) else 0.0, MAX_LATITUDE)
+        # Longitude degrees shrink towards the poles, size cells for the worst case
+        self.cell_lng = self.cell_lat / math.cos(math.radians(max_lat))
+        self.cells = pd.DataFrame({
+            'pos': np.arange(len(self.lat)),
+            'x': np.floor(self.lat / self.cell_lat).astype(np.int64),
+            'y': np.floor(self.lng / self.cell_lng).astype(np.int64),
+        })
+
+    def pairs(self):
+        found = []
+        for dx, dy in NEIGHBOUR_CELLS:
+            other = self.cells.assign(x=self.cells['x'] - dx, y=self.cells['y'] - dy)
+            candidates = self.cells.merge(other, on=['x', 'y'])
+            a, b = candidates['pos_x'].values, candidates['pos_y'].values
+            if (dx, dy) == (0, 0):
+                keep = a < b
+                a, b = a[keep], b[keep]
+            near = haversine(self.lat[a], self.lng[a], self.lat[b], self.lng[b]) <= self.radius
+            found.append(np.column_stack((a[near], b[near])))
+        pairs = np.concatenate(found) if found else np.empty((0, 2), dtype=np.int64)
+        pairs = self.positions[pairs]
+        pairs = np.sort(pairs, axis=1)
+        return pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
+    def query(self, lat, lng):
+        x = int(math.floor(lat / self.cell_lat))
+        y = int(math.floor(lng / self.cell_lng))
+        cells = self.cells
+        near = cells[cells['x'].between(x - 1, x + 1) & cells['y'].between(y - 1, y + 1)]['pos'].values
+        distance = haversine(lat, lng, self.lat[near], self.lng[near])
+        return self.positions[near[distance <= self.radius]]
+
+
+def neighbour_pairs(df, radius=0.5):
+    index = GridIndex(df['lat'].values, df['lng'].values, radius=radius)
+    pairs = index.pairs()
+    a, b = pairs[:, 0], pairs[:, 1]
+    types = df['type'].values
+    companies = df['company'].values
+    # Different types never match, the same company means different people
+    return pairs[(types[a] == types[b]) & (companies[a] != companies[b])]
@@ -0,0 +1,320 @@
+import hashlib
+import json
+import math
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from .spatial import KM_PER_DEGREE, haversine
+
+
+SCHEMA_VERSION = 2
+CHUNK_SIZE = 5000
+QUERY_CHUNK = 500
+# Columns of their own, everything else an entity has goes to the extra JSON
+ENTITY_FIELDS = ['uid', 'slug', 'slug_raw', 'type', 'name', 'title', 'first_name', 'last_name', 'address',
+                 'postcode', 'location', 'country', 'lat', 'lng']
+PAYMENT_FIELDS = ['company', 'currency', 'type', 'year', 'recipient_detail', 'label', 'amount']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entities (
+    id INTEGER PRIMARY KEY,
+    uid TEXT NOT NULL UNIQUE,
+    slug TEXT,
+    slug_raw TEXT,
+    type TEXT,
+    name TEXT,
+    title TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    address TEXT,
+    postcode TEXT,
+    location TEXT,
+    country TEXT,
+    lat REAL,
+    lng REAL,
+    recipient_detail TEXT,
+    amount REAL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS entities_slug ON entities (slug);
+CREATE INDEX IF NOT EXISTS entities_postcode ON entities (postcode);
+CREATE INDEX IF NOT EXISTS entities_latlng ON entities (lat, lng);
+CREATE TABLE IF NOT EXISTS payments (
+    entity_id INTEGER NOT NULL REFERENCES entities (id) ON DELETE CASCADE,
+    company TEXT,
+    currency TEXT,
+    type TEXT,
+    year INTEGER,
+    recipient_detail TEXT,
+    label TEXT,
+    amount REAL
+);
+CREATE INDEX IF NOT EXISTS payments_entity ON payments (entity_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts USING fts5 (
+    name, first_name, last_name, location, recipient_detail,
+    content='entities', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS entities_ai AFTER INSERT ON entities BEGIN
+    INSERT INTO entities_fts (rowid, name, first_name, last_name, location, recipient_detail)
+    VALUES (new.id, new.name, new.first_name, new.last_name, new.location, new.recipient_detail);
+END;
+CREATE TRIGGER IF NOT EXISTS entities_ad AFTER DELETE ON entities BEGIN
+    INSERT INTO entities_fts (entities_fts, rowid, name, first_name, last_name, location, recipient_detail)
+    VALUES ('delete', old.id, old.name, old.first_name, old.last_name, old.location, old.recipient_detail);
+END;
+CREATE TRIGGER IF NOT EXISTS entities_au AFTER UPDATE ON entities BEGIN
+    INSERT INTO entities_fts (entities_fts, rowid, name, first_name, last_name, location, recipient_detail)
+    VALUES ('delete', old.id, old.name, old.first_name, old.last_name, old.location, old.recipient_detail);
+    INSERT INTO entities_fts (rowid, name, first_name, last_name, location, recipient_detail)
+    VALUES (new.id, new.name, new.first_name, new.last_name, new.location, new.recipient_detail);
+END;
+'''
+# Schema changes by version, applied in order on older stores
+MIGRATIONS = {
+    2: 'ALTER TABLE entities ADD COLUMN hash TEXT',
+}
+
+COLUMNS = ENTITY_FIELDS + ['recipient_detail', 'amount', 'extra', 'hash']
+# Rows whose content hash is unchanged are not rewritten, their FTS triggers don't fire
+UPSERT = ('INSERT INTO entities (%s) VALUES (%s) ON CONFLICT (uid) DO UPDATE SET %s '
+          'WHERE entities.hash IS NOT excluded.hash' % (
+              ', '.join(COLUMNS), ', '.join('?' * len(COLUMNS)),
+              ', '.join('%s = excluded.%s' % (c, c) for c in COLUMNS if c != 'uid')))
+WORD = re.compile(r'\w+', re.U)
+
+
+def _value(val):
+    if val is None:
+        return None
+    if isinstance(val, float) and math.isnan(val):
+        return None
+    if hasattr(val, 'item'):
+        return _value(val.item())
+    return val
+
+
+def _payments(val):
+    if isinstance(val, list):
+        return val
+    if val is None or (isinstance(val, float) and math.isnan(val)) or not val:
+        return []
+    return json.loads(val)
+
+
+def entity_row(entity):
+    # (entity columns, payment rows) for one make_entities record
+    entity = {k: _value(v) for k, v in entity.items()}
+    payments = [{f: _value(p.get(f)) for f in PAYMENT_FIELDS} for p in _payments(entity.pop('payments', None))]
+    details = sorted(set(p['recipient_detail'] for p in payments if p['recipient_detail']))
+    extra = {k: v for k, v in entity.items() if k not in ENTITY_FIELDS and v is not None}
+    row = [entity.get(f) for f in ENTITY_FIELDS]
+    row += [' '.join(details) or None, sum(p['amount'] or 0 for p in payments),
+            json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else None]
+    payments = [[p[f] for f in PAYMENT_FIELDS] for p in payments]
+    row.append(hashlib.sha1(json.dumps([row, payments], default=str).encode('utf-8')).hexdigest())
+    return row, payments
+
+
+def _records(entities):
+    if isinstance(entities, pd.DataFrame):
+        return entities.to_dict('records')
+    return entities
+
+
+def match_query(text, column=None):
+    # Every word of the text as a prefix, FTS5 syntax in the input is not interpreted
+    words = WORD.findall(text or '')
+    prefix = '%s : ' % column if column else ''
+    return ' '.join('%s"%s"*' % (prefix, w) for w in words)
+
+
+class EntityStore(object):
+    def __init__(self, path='entities.db'):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        # Entities the last upsert inserted or rewrote
+        self.changed = 0
+        self.migrate()
+
+    def version(self):
+        return self.conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def migrate(self):
+        version = self.version()
+        if version >= SCHEMA_VERSION:
+            return
+        with self.conn:
+            if version < 1:
+                self.conn.executescript(SCHEMA)
+            for number in sorted(MIGRATIONS):
+                if version < number:
+                    self.conn.execute(MIGRATIONS[number])
+            self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def upsert(self, entities, prune=False, chunk_size=CHUNK_SIZE):
+        # Inserts new and replaces changed entities with their payments, in one transaction. Unchanged
+        # entities are not touched. prune deletes the stored entities that are not among them, for a
+        # full export.
+        seen = []
+        chunk = []
+        self.changed = 0
+        with self.conn:
+            for entity in _records(entities):
+                chunk.append(entity_row(entity))
+                if len(chunk) >= chunk_size:
+                    seen.extend(self._write(chunk))
+                    chunk = []
+            seen.extend(self._write(chunk))
+            if prune:
+                self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (uid TEXT PRIMARY KEY)')
+                self.conn.execute('DELETE FROM seen')
+                self.conn.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(uid,) for uid in seen])
+                self.conn.execute('DELETE FROM entities WHERE uid NOT IN (SELECT uid FROM seen)')
+        return len(seen)
+
+    def _write(self, chunk):
+        if not chunk:
+            return []
+        uids = [row[0] for row, _ in chunk]
+        stored = dict(self._select('SELECT uid, hash FROM entities WHERE uid IN (%s)', uids))
+        changed = [(row, payments) for row, payments in chunk if stored.get(row[0], False) != row[-1]]
+        if not changed:
+            return uids
+        self.conn.executemany(UPSERT, [row for row, _ in changed])
+        ids = dict(self._select('SELECT uid, id FROM entities WHERE uid IN (%s)', [row[0] for row, _ in changed]))
+        self.conn.executemany('DELETE FROM payments WHERE entity_id = ?', [(ids[row[0]],) for row, _ in changed])
+        self.conn.executemany(
+            'INSERT INTO payments (entity_id, %s) VALUES (?, %s)' % (', '.join(PAYMENT_FIELDS),
+                                                                     ', '.join('?' * len(PAYMENT_FIELDS))),
+            [[ids[row[0]]] + payment for row, payments in changed for payment in payments])
+        self.changed += len(changed)
+        return uids
+
+    def _select(self, query, values):
+        # query with one IN (%s) list, run in chunks below SQLite's variable limit
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), QUERY_CHUNK):
+            part = values[start:start + QUERY_CHUNK]
+            rows.extend(self.conn.execute(query % ', '.join('?' * len(part)), part).fetchall())
+        return rows
+
+    def delete(self, uids):
+        with self.conn:
+            self.conn.executemany('DELETE FROM entities WHERE uid = ?', [(uid,) for uid in uids])
+
+    def _entities(self, rows, payments=True):
+        entities = []
+        for row in rows:
+            entity = dict(row)
+            extra = entity.pop('extra')
+            entity.update(json.loads(extra) if extra else {})
+            entities.append(entity)
+        if payments and entities:
+            found = {}
+            for row in self._select('SELECT * FROM payments WHERE entity_id IN (%s)', [e['id'] for e in entities]):
+                payment = dict(row)
+                found.setdefault(payment.pop('entity_id'), []).append(payment)
+            for entity in entities:
+                entity['payments'] = found.get(entity['id'], [])
+        for entity in entities:
+            del entity['id']
+        return entities
+
+    def _one(self, column, value, payments=True):
+        rows = self.conn.execute('SELECT * FROM entities WHERE %s = ?' % column, (value,)).fetchall()
+        entities = self._entities(rows, payments=payments)
+        return entities[0] if entities else None
+
+    def get(self, uid, payments=True):
+        return self._one('uid', uid, payments=payments)
+
+    def by_slug(self, slug, payments=True):
+        return self._one('slug', slug, payments=payments)
+
+    def by_postcode(self, postcode, limit=100, payments=False):
+        rows = self.conn.execute('SELECT * FROM entities WHERE postcode = ? ORDER BY amount DESC LIMIT ?',
+                                 (postcode, limit)).fetchall()
+        return self._entities(rows, payments=payments)
+
+    def search(self, text, type=None, location=None, limit=20, payments=False):
+        # Full text search over names, locations and recipient details, best matches first
+        query = ' '.join(q for q in (match_query(text), match_query(location, column='location')) if q)
+        if not query:
+            return []
+        sql = ('SELECT entities.* FROM entities_fts JOIN entities ON entities.id = entities_fts.rowid '
+               'WHERE entities_fts MATCH ?')
+        params = [query]
+        if type is not None:
+            sql += ' AND entities.type = ?'
+            params.append(type)
+        sql += ' ORDER BY bm25(entities_fts), entities.amount DESC LIMIT ?'
+        params.append(limit)
+        return self._entities(self.conn.execute(sql, params).fetchall(), payments=payments)
+
+    def near(self, lat, lng, radius=1.0, limit=100, payments=False):
+        # Bounding box on the lat/lng index, then exact distances, nearest first
+        dlat = radius / KM_PER_DEGREE
+        dlng = dlat / max(math.cos(math.radians(lat)), 0.01)
+        rows = self.conn.execute('SELECT * FROM entities WHERE lat BETWEEN ? AND ? AND lng BETWEEN ? AND ?',
+                                 (lat - dlat, lat + dlat, lng - dlng, lng + dlng)).fetchall()
+        distance = haversine(lat, lng, np.array([row['lat'] for row in rows], dtype=float),
+                             np.array([row['lng'] for row in rows], dtype=float))
+        found = [i for i in np.argsort(distance, kind='stable')[:limit] if distance[i] <= radius]
+        entities = self._entities([rows[i] for i in found], payments=payments)
+        for entity, i in zip(entities, found):
+            entity['distance'] = float(distance[i])
+        return entities
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM entities').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def write_store(entities, filename):
+    # Export target for make_entities output, entities gone from the export are removed
+    store = EntityStore(filename)
+    try:
+        return store.upsert(entities, prune=True)
+    finally:
+        store.close()
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python -m eurosfordoctors.store',
+                                     description='Look up entities in an entity store.')
+    parser.add_argument('store', help='entity store .db')
+    parser.add_argument('query', nargs='?', default='', help='words of a name, city or recipient detail')
+    parser.add_argument('--slug')
+    parser.add_argument('--postcode')
+    parser.add_argument('--type', choices=['hcp', 'hco'])
+    parser.add_argument('--location', help='words the location has to match')
+    parser.add_argument('-n', '--limit', type=int, default=20)
+    args = parser.parse_args(argv)
+    store = EntityStore(args.store)
+    try:
+        if args.slug:
+            found = [e for e in [store.by_slug(args.slug)] if e is not None]
+        elif args.postcode:
+            found = store.by_postcode(args.postcode, limit=args.limit)
+        else:
+            found = store.search(args.query, type=args.type, location=args.location, limit=args.limit)
+    finally:
+        store.close()
+    for entity in found:
+        print(json.dumps(entity, ensure_ascii=False, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
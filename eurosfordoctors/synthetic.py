@@ -0,0 +1,296 @@
+import os
+import time
+import zlib
+
+import numpy as np
+import pandas as pd
+from slugify import slugify
+
+from .utils import MONEY_FIELDS
+
+
+DEFAULT_SEED = 2015
+DUPLICATE_RATE = 0.3
+HCO_SHARE = 0.15
+# Share of the entities that only one company paid going to abbvie, the rest go to bayer
+ABBVIE_SHARE = 0.4
+NOISE = 0.1
+# utils.MONEY_FIELDS_ONLY comes from a set, its order changes between runs
+AMOUNTS = [f for f in MONEY_FIELDS if f != 'total']
+
+ABBVIE_COLUMNS = ['name', 'location', 'country', 'address'] + AMOUNTS + ['total', 'type']
+BAYER_COLUMNS = (['name', 'uci', 'address', 'location', 'country'] + AMOUNTS +
+                 ['company_doc_id', 'currency', 'type'])
+FILENAMES = {'abbvie': 'abbvie_pl_2015.csv', 'bayer': 'bayer_pl_2015.csv'}
+TRUTH = 'truth.csv'
+
+FIRST_NAMES = {
+    'f': ['Agata', 'Agnieszka', 'Aleksandra', 'Alicja', 'Anna', 'Barbara', 'Beata', 'Bożena', 'Danuta',
+          'Dorota', 'Elżbieta', 'Ewa', 'Grażyna', 'Halina', 'Hanna', 'Irena', 'Iwona', 'Jadwiga', 'Joanna',
+          'Jolanta', 'Justyna', 'Karolina', 'Katarzyna', 'Krystyna', 'Lidia', 'Magdalena', 'Małgorzata',
+          'Maria', 'Marta', 'Monika', 'Natalia', 'Paulina', 'Renata', 'Sylwia', 'Teresa', 'Urszula',
+          'Wanda', 'Zofia'],
+    'm': ['Adam', 'Andrzej', 'Artur', 'Bogdan', 'Dariusz', 'Grzegorz', 'Henryk', 'Jacek', 'Jakub', 'Jan',
+          'Janusz', 'Jarosław', 'Jerzy', 'Józef', 'Kazimierz', 'Krzysztof', 'Leszek', 'Łukasz', 'Maciej',
+          'Marcin', 'Marek', 'Mariusz', 'Michał', 'Mirosław', 'Paweł', 'Piotr', 'Rafał', 'Robert',
+          'Ryszard', 'Sławomir', 'Stanisław', 'Tadeusz', 'Tomasz', 'Wiesław', 'Witold', 'Wojciech',
+          'Zbigniew', 'Zdzisław'],
+}
+# -ski and -cki surnames take the feminine -ska and -cka, the others are the same for both
+LAST_NAMES = ['Bartkowski', 'Borowski', 'Chmielewski', 'Czarnecki', 'Dąbrowski', 'Gajewski',
+              'Górski', 'Grabowski', 'Jabłoński', 'Jankowski', 'Jaworski', 'Kalinowski', 'Kamiński',
+              'Kowalski', 'Kozłowski', 'Kwiatkowski', 'Lewandowski', 'Majewski', 'Malinowski',
+              'Michalski', 'Olszewski', 'Ostrowski', 'Pawłowski', 'Piotrowski', 'Rutkowski',
+              'Sadowski', 'Szymański', 'Śniatkowski', 'Tomaszewski', 'Wilkowski', 'Wiśniewski',
+              'Wojciechowski', 'Wysocki', 'Zalewski', 'Zawadzki', 'Zieliński', 'Żurawski',
+              'Bartnicki', 'Laskowski', 'Sokołowski', 'Aleksiejczyk', 'Baran', 'Beniowski',
+              'Botuliński', 'Dudek', 'Jasiński', 'Kaczmarek', 'Karpiuk', 'Korol', 'Krawczyk',
+              'Król', 'Mazur', 'Michalak', 'Nowak', 'Pawlak', 'Sikora', 'Stępień', 'Szewczyk',
+              'Walczak', 'Wieczorek', 'Wójcik', 'Wróbel', 'Zając', 'Adamczyk', 'Dudziak', 'Górecki',
+              'Kubiak', 'Lis', 'Majchrzak', 'Nowakowski', 'Pietrzak', 'Sobczak', 'Wawrzyniak',
+              'Woźniak', 'Żak', 'Kołodziej', 'Cieślak', 'Kowalczyk', 'Jakubowski', 'Kaczmarczyk']
+DOUBLE_NAME_RATE = 0.05
+TITLES = ['Dr.', 'Dr.', 'Dr. med.', 'Prof.', 'Prof. Dr.']
+TITLE_RATE = 0.25
+
+HCO_NAMES = ['Szpital Specjalistyczny im. {last}', 'Wojewódzki Szpital Zespolony w {city}',
+             'Fundacja Rozwoju {field}', 'Stowarzyszenie Przyjaciół {field} w {city}',
+             'Przychodnia {street}', 'Polskie Towarzystwo {field}', 'Klinika {field} {last}',
+             '{last} Sp. z o.o.', 'Centrum Medyczne {street}', 'SP ZOZ {city}']
+FIELDS = ['Kardiologii', 'Onkologii', 'Okulistyki', 'Reumatologii', 'Hepatologii', 'Pediatrii',
+          'Diabetologii', 'Neurologii', 'Dermatologii', 'Urologii']
+
+STREETS = ['Akacjowa', 'Armii Krajowej', 'Batorego', 'Curie-Skłodowskiej', 'Dąbrowskiego', 'Długa',
+           'Filtrowa', 'Grunwaldzka', 'Jagiellońska', 'Kasztanowa', 'Kościuszki', 'Krakowska',
+           'Kniaziewicza', 'Lipowa', 'Lwowska', 'Mickiewicza', 'Modrzewiowa', 'Narutowicza',
+           'Ogrodowa', 'Piłsudskiego', 'Polna', 'Roentgena', 'Rydygiera', 'Sienkiewicza',
+           'Słoneczna', 'Sokola', 'Stołeczna', 'Storczykowa', 'Szpitalna', 'Transportowa',
+           'Wołoska', 'Wojska Polskiego', 'Wyzwolenia', 'Zjednoczenia', 'Żeromskiego',
+           'Żwirki i Wigury', 'Bohaterów Westerplatte', 'Broniewskiego', 'Chopina', 'Fieldorfa',
+           'Garbary', 'Hallera', 'Jana Pawła II', 'Kilińskiego', 'Kochanowskiego', 'Konopnickiej',
+           'Kopernika', 'Kraszewskiego', 'Legionów', 'Leśna', 'Marszałkowska', 'Mazowiecka',
+           'Miodowa', 'Moniuszki', 'Niepodległości', 'Nowowiejska', 'Orzeszkowej', 'Pomorska',
+           'Poniatowskiego', 'Prusa', 'Reymonta', 'Różana', 'Sobieskiego', 'Szkolna', 'Śląska',
+           'Traugutta', 'Wileńska', 'Wolska', 'Zamojskiego', 'Zielona', 'Żelazna', 'Banacha']
+AVENUES = ('Armii Krajowej', 'Wojska Polskiego', 'Piłsudskiego')
+CITIES = ['Białystok', 'Bydgoszcz', 'Chorzów', 'Częstochowa', 'Gdańsk', 'Gdynia', 'Gliwice',
+          'Katowice', 'Kielce', 'Kraków', 'Lublin', 'Łódź', 'Olsztyn', 'Opole', 'Poznań', 'Radom',
+          'Rzeszów', 'Szczecin', 'Toruń', 'Warszawa', 'Wrocław', 'Zabrze', 'Zielona Góra',
+          'Bielsko-Biała', 'Elbląg', 'Gorzów Wielkopolski', 'Kalisz', 'Koszalin', 'Legnica',
+          'Nowy Sącz', 'Płock', 'Piotrków Trybunalski', 'Siedlce', 'Słupsk', 'Sosnowiec', 'Tarnów',
+          'Wałbrzych', 'Włocławek', 'Zamość', 'Bytom']
+# Locative forms for "Szpital w ..."
+LOCATIVE = {'Białystok': 'Białymstoku', 'Kraków': 'Krakowie', 'Warszawa': 'Warszawie', 'Łódź': 'Łodzi',
+            'Gdańsk': 'Gdańsku', 'Poznań': 'Poznaniu', 'Wrocław': 'Wrocławiu', 'Lublin': 'Lublinie'}
+
+STREET_PREFIXES = {'abbvie': ['ul.', 'ul.', 'ul.', 'al.'], 'bayer': ['ul.', 'ul. ', 'Ul.', 'Ul. ', '']}
+APARTMENT_RATE = 0.3
+ASCII = str.maketrans('ąćęłńóśźżĄĆĘŁŃÓŚŹŻ', 'acelnoszzACELNOSZZ')
+
+
+def feminine(name):
+    return name[:-1] + 'a' if name.endswith(('ski', 'cki')) else name
+
+
+def _choice(rng, values, size):
+    return np.asarray(values, dtype=object)[rng.integers(0, len(values), size)]
+
+
+def make_truth(n, rng, hco_share=HCO_SHARE):
+    # One row per real world entity, the id is its position
+    hco = rng.random(n) < hco_share
+    gender = np.where(rng.random(n) < 0.5, 'f', 'm')
+    first = np.where(gender == 'f', _choice(rng, FIRST_NAMES['f'], n), _choice(rng, FIRST_NAMES['m'], n))
+    last = [feminine(name) if g == 'f' else name for name, g in zip(_choice(rng, LAST_NAMES, n), gender)]
+    double = np.nonzero(rng.random(n) < DOUBLE_NAME_RATE)[0]
+    for i, name in zip(double, _choice(rng, LAST_NAMES, len(double))):
+        last[i] = '%s-%s' % (last[i], feminine(name) if gender[i] == 'f' else name)
+    truth = pd.DataFrame({
+        'entity': np.arange(n),
+        'type': np.where(hco, 'hco', 'hcp'),
+        'gender': gender,
+        'first_name': first,
+        'last_name': last,
+        'title': np.where(rng.random(n) < TITLE_RATE, _choice(rng, TITLES, n), ''),
+        'street': _choice(rng, STREETS, n),
+        'number': rng.integers(1, 200, n).astype(str),
+        'apartment': np.where(rng.random(n) < APARTMENT_RATE, rng.integers(1, 120, n).astype(str), ''),
+        'city': _choice(rng, CITIES, n),
+    })
+    templates = _choice(rng, HCO_NAMES, n)
+    fields = _choice(rng, FIELDS, n)
+    truth['org_name'] = [t.format(last=l, city=LOCATIVE.get(c, c), street=s, field=f) if h else ''
+                         for t, l, c, s, f, h in zip(templates, truth['last_name'], truth['city'],
+                                                     truth['street'], fields, hco)]
+    return truth
+
+
+def typo(val, rng):
+    if len(val) < 6:
+        return val
+    i = int(rng.integers(1, len(val) - 1))
+    kind = rng.integers(0, 3)
+    if kind == 0:
+        return val[:i] + val[i + 1:]
+    if kind == 1:
+        return val[:i - 1] + val[i] + val[i - 1] + val[i + 1:]
+    return val[:i] + val[i] + val[i:]
+
+
+def add_noise(rows, rng, rate=NOISE):
+    # Independent per row and field, the same entity looks different at each company
+    rows = rows.copy()
+    n = len(rows)
+    for column in ('first_name', 'last_name', 'org_name', 'street', 'city'):
+        values = rows[column].tolist()
+        strip = rng.random(n) < rate
+        typos = rng.random(n) < rate / 2
+        for i in np.nonzero(strip | typos)[0]:
+            val = values[i]
+            if strip[i]:
+                val = val.translate(ASCII)
+            if typos[i] and column != 'city':
+                val = typo(val, rng)
+            values[i] = val
+        rows[column] = values
+    rows['title'] = rows['title'].where(rng.random(n) >= rate, '')
+    rows['apartment'] = rows['apartment'].where(rng.random(n) >= rate, '')
+    return rows
+
+
+def _upper(values, mask):
+    return [v.upper() if m else v for v, m in zip(values, mask)]
+
+
+def make_amounts(n, rng):
+    # One to three labels per row, log-normal amounts
+    amounts = np.full((n, len(AMOUNTS)), np.nan)
+    labels = rng.integers(1, 4, n)
+    for k in range(3):
+        rows = np.nonzero(labels > k)[0]
+        columns = rng.integers(0, len(AMOUNTS), len(rows))
+        amounts[rows, columns] = np.round(rng.lognormal(7.5, 1.0, len(rows)))
+    return pd.DataFrame(amounts, columns=AMOUNTS)
+
+
+def _street(rows, rng, company):
+    prefix = _choice(rng, STREET_PREFIXES[company], len(rows))
+    prefix = np.where(rows['street'].isin(AVENUES) & (prefix != ''), 'al.', prefix)
+    address = prefix + rows['street'].values + ' ' + rows['number'].values
+    if company == 'abbvie':
+        apartment = np.where(rows['apartment'] != '', '/' + rows['apartment'], '')
+    else:
+        apartment = np.where(rows['apartment'] != '',
+                             _choice(rng, [' lok. ', ' l.', '/'], len(rows)) + rows['apartment'], '')
+    return address + apartment
+
+
+def render_abbvie(rows, rng):
+    hcp = (rows['type'] == 'hcp').values
+    names = np.where(hcp, rows['last_name'] + ', ' + rows['first_name'], rows['org_name'])
+    df = pd.DataFrame({
+        'name': names,
+        'location': None,
+        'country': 'PL',
+        'address': _street(rows, rng, 'abbvie') + ', ' + rows['city'].values + ', PL',
+    })
+    amounts = make_amounts(len(rows), rng).astype('Int64')
+    df = pd.concat([df, amounts], axis=1)
+    df['total'] = amounts.sum(axis=1)
+    df['type'] = rows['type'].values
+    return df[ABBVIE_COLUMNS]
+
+
+def render_bayer(rows, rng, start=61000):
+    hcp = (rows['type'] == 'hcp').values
+    titled = rows['title'].values != ''
+    names = np.where(titled, rows['title'] + ' ', '') + rows['first_name'] + ' ' + rows['last_name']
+    names = np.where(hcp, names, rows['org_name'])
+    upper = rng.random(len(rows)) < np.where(hcp, 0.02, 0.3)
+    city = rows['city'].values
+    df = pd.DataFrame({
+        'name': _upper(names, upper),
+        'uci': None,
+        'address': _upper(_street(rows, rng, 'bayer'), upper),
+        'location': _upper(city, upper),
+        'country': 'PL',
+    })
+    df = pd.concat([df, make_amounts(len(rows), rng)], axis=1)
+    df['company_doc_id'] = ['BAYER-2015-%05d' % (start + i) for i in range(len(rows))]
+    df['currency'] = 'PLN'
+    df['type'] = rows['type'].values
+    return df[BAYER_COLUMNS]
+
+
+RENDERERS = {'abbvie': render_abbvie, 'bayer': render_bayer}
+
+
+def make_dataset(rows, seed=DEFAULT_SEED, duplicate_rate=DUPLICATE_RATE, noise=NOISE):
+    # duplicate_rate is the share of entities paid by both companies, rows counts both files
+    rng = np.random.default_rng(seed)
+    n = int(round(rows / (1 + duplicate_rate)))
+    truth = make_truth(n, rng)
+    both = rng.random(n) < duplicate_rate
+    abbvie = both | (~both & (rng.random(n) < ABBVIE_SHARE))
+    bayer = both | ~abbvie
+    frames = {}
+    entities = {}
+    for company, member in (('abbvie', abbvie), ('bayer', bayer)):
+        ids = rng.permutation(np.nonzero(member)[0])
+        paid = add_noise(truth.iloc[ids].reset_index(drop=True), rng, noise)
+        frames[company] = RENDERERS[company](paid, rng)
+        entities[company] = ids
+    return frames, entities, truth
+
+
+def write_dataset(dirname, rows, seed=DEFAULT_SEED, duplicate_rate=DUPLICATE_RATE, noise=NOISE):
+    # Raw CSVs like data/pl/raw_csv plus truth.csv with the entity of every row
+    raw_dir = os.path.join(dirname, 'raw_csv')
+    os.makedirs(raw_dir, exist_ok=True)
+    frames, entities, truth = make_dataset(rows, seed=seed, duplicate_rate=duplicate_rate, noise=noise)
+    for company, df in frames.items():
+        df.to_csv(os.path.join(raw_dir, FILENAMES[company]), index=False, encoding='utf-8')
+    rows = pd.concat([pd.DataFrame({'company': company, 'row': np.arange(len(ids)), 'entity': ids})
+                      for company, ids in entities.items()], ignore_index=True)
+    rows.to_csv(os.path.join(dirname, TRUTH), index=False)
+    return raw_dir, rows
+
+
+def read_truth(dirname):
+    return pd.read_csv(os.path.join(dirname, TRUTH))
+
+
+def _digest(val):
+    return zlib.crc32(val.encode('utf-8')) / float(2 ** 32)
+
+
+class StubProvider(object):
+    # Offline geocoder, every address of a street lands within about a kilometre of its city
+    IGNORED = frozenset(['ul', 'al', 'pl', 'ulica', 'lok', 'l', 'im'])
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def _street_key(self, address):
+        tokens = slugify(address).lower().split('-')
+        words = [t for t in tokens if t not in self.IGNORED and not t.isdigit()]
+        numbers = [t for t in tokens if t.isdigit()]
+        return '-'.join(words), numbers[0] if numbers else ''
+
+    def __call__(self, search, language, country=None):
+        if self.latency:
+            time.sleep(self.latency)
+        address, _, place = search.rpartition(',')
+        city = slugify(place).lower()
+        if not city:
+            properties = {'status': 'ZERO_RESULTS', 'address': search}
+            return [None, None], {'type': 'Feature', 'properties': properties}
+        street, number = self._street_key(address)
+        lat = 49.5 + 4.5 * _digest(city) + 0.008 * (_digest(street) - 0.5) + 0.0002 * (_digest(number) - 0.5)
+        lng = 15.0 + 8.0 * _digest(city[::-1]) + 0.012 * (_digest(street[::-1]) - 0.5)
+        postal = '%02d-%03d' % (int(_digest(city) * 100), int(_digest(city + street) * 1000))
+        properties = {'status': 'OK', 'address': search, 'lat': lat, 'lng': lng, 'postal': postal,
+                      'city': place.strip(), 'country': country}
+        geojson = {'type': 'Feature', 'properties': properties,
+                   'geometry': {'type': 'Point', 'coordinates': [lng, lat]}}
+        return [lat, lng], geojson
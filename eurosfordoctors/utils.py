@@ -1,24 +1,14 @@
 import json
 
 import pandas as pd
-import pyprind
+
+from .metrics import progress_apply
 
 
 def progress_pandas_df():
-    def inner(df, func, *args, **kwargs):
-        df_len = len(df) + 1
-        progress_logger = pyprind.ProgPercent(df_len)
-
-        def wrapper(*args, **kwargs):
-            try:
-                progress_logger.update()
-            except ValueError:
-                pass
-            return func(*args, **kwargs)
-        result = df.apply(wrapper, *args, **kwargs)
-        return result
-    pd.DataFrame.progress_apply = inner
-    pd.Series.progress_apply = inner
+    # Progress is logged every few seconds instead of redrawn on every row
+    pd.DataFrame.progress_apply = progress_apply
+    pd.Series.progress_apply = progress_apply
 
 
 MONEY_FIELDS = 'donations_grants	sponsorship	registration_fees	travel_accommodation	fees	related_expenses	total'.split()
@@ -0,0 +1,142 @@
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+from eurosfordoctors import columnar, fixers
+from eurosfordoctors.pipeline import make_settings, read_raw
+from eurosfordoctors.rules import NAMED_RULES
+
+
+RAW_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'pl', 'raw_csv')
+RAW_FILES = sorted(glob.glob(os.path.join(RAW_DIR, '*.csv')))
+
+PL_SETTINGS = {
+    'no_postcode': ['abbvie', 'bayer'],
+    'no_pdf': ['bayer'],
+    'address_rules': {'abbvie': 'address_location_country_comma'},
+}
+# One company per flag, and one for each kind of address rule
+FLAG_SETTINGS = {
+    'bad_name_order': ['order', 'capitals'],
+    'last_name_capitals': ['capitals'],
+    'comma_split_title': ['title'],
+    'comma_split_title_name': ['titlename'],
+    'semicolon_name_split': ['semicolon'],
+    'no_postcode': ['nopostcode'],
+    'proper_postcode': ['proper'],
+    'no_pdf': ['order'],
+    'hcp_company_in_address': ['practice'],
+    'address_rules': {
+        'named': 'address_location_country_comma',
+        'split': {'split': ';', 'columns': ['address', 'location']},
+        'regex': {'regex': '(?P<address>.+), (?P<postcode>\\d{2}-\\d{3}) (?P<location>.+)'},
+        'callback': fixers.parse_address_location_country_comma,
+    },
+}
+FLAG_ROWS = [
+    # company, type, name, address, location
+    ('plain', 'hcp', 'Dr. med. Jan KOWALSKI', 'Hauptstrasse 12, 10115 Berlin', None),
+    ('plain', 'hcp', 'Herr Prof. Dr. Hans Müller', 'Lindenweg 1214', 'BERLIN'),
+    ('plain', 'hco', 'Klinikum Nord - Abteilung Kardiologie', 'Kliniczna 5', '00-950 WARSZAWA'),
+    ('plain', 'hco', 'Verein für Medizin e. V.', None, 'Hamburg'),
+    ('order', 'hcp', 'Kowalski Jan', 'ul. Marszałkowska 10, Warszawa', None),
+    ('order', 'hcp', 'Nowak, Anna', 'Aleje 3', 'Kraków'),
+    ('capitals', 'hcp', 'KOWALSKI-NOWAK Jan Maria', 'Długa 5', 'Gdańsk'),
+    ('title', 'hcp', 'Anna Nowak, Dr. med.', 'Polna 1', 'Poznań'),
+    ('title', 'hcp', 'Anna Nowak', 'Polna 2', 'Poznań'),
+    ('titlename', 'hcp', 'Nowak, Prof. Dr., Anna', 'Polna 3', 'Poznań'),
+    ('titlename', 'hcp', 'Nowak, Anna', 'Polna 4', 'Poznań'),
+    ('semicolon', 'hcp', 'Herr Jan;Kowalski', 'Krótka 1', 'Łódź'),
+    ('semicolon', 'hcp', 'Frau Anna; Nowak', 'Krótka 2', 'Łódź'),
+    ('nopostcode', 'hcp', 'Jan Kowalski', 'Weg 5 12345', '12345 Berlin'),
+    ('proper', 'hcp', 'Jan Kowalski', 'Weg 6, 12345 Berlin', None),
+    ('practice', 'hcp', 'Jan Kowalski', 'Praxis Müller, Hauptstr. 5, Berlin', None),
+    ('practice', 'hcp', 'Anna Nowak', 'Hauptstr. 6, Berlin', None),
+    ('named', 'hcp', 'Jan Kowalski', 'ul. Długa 5, Kraków, Polska', None),
+    ('named', 'hco', 'Szpital Miejski', 'ul. Długa 6, Kraków, PL', None),
+    ('named', 'hcp', 'Anna Nowak', 'ul. Długa 12, Kraków', None),
+    ('named', 'hcp', 'Piotr Zieliński', 'ul. Długa 13, Nowa Huta, Kraków, PL', None),
+    ('split', 'hcp', 'Jan Kowalski', 'ul. Długa 7; Kraków', None),
+    ('split', 'hcp', 'Anna Nowak', 'ul. Długa 8', None),
+    ('regex', 'hcp', 'Jan Kowalski', 'ul. Długa 9, 30-001 Kraków', None),
+    ('regex', 'hcp', 'Anna Nowak', 'ul. Długa 10 Kraków', None),
+    ('callback', 'hcp', 'Jan Kowalski', 'ul. Długa 11, Kraków, Polska', None),
+    ('callback', 'hcp', 'Anna Nowak', 'ul. Długa 14, Kraków', None),
+]
+
+
+def prepare(df, company):
+    # The part of pipeline.clean_frame before the fixers
+    df = df[df['name'].notnull()].copy()
+    df['type'] = df['type'].str.lower()
+    df['recipient_detail'] = None
+    df['company'] = company
+    return fixers.make_money(df)
+
+
+def flag_frame():
+    df = pd.DataFrame(FLAG_ROWS, columns=['company', 'type', 'name', 'address', 'location'])
+    df['country'] = None
+    df['recipient_detail'] = None
+    return df
+
+
+def rowwise(df, settings):
+    df = df.apply(lambda row: fixers.fix_name(row, settings), axis=1)
+    df = df.apply(lambda row: fixers.split_name(row, settings), axis=1)
+    detail = df['recipient_detail'].astype(object)
+    df['recipient_detail'] = detail.where(detail.notnull(), None)
+    return df.apply(lambda row: fixers.fix_address(row, settings), axis=1)
+
+
+def columnwise(df, settings):
+    df = columnar.fix_name(df, settings)
+    df = columnar.split_name(df, settings)
+    return columnar.fix_address(df, settings)
+
+
+def normalize(df):
+    df = df[sorted(df.columns)].astype(object)
+    return df.where(df.notnull(), None)
+
+
+def assert_same(df, settings):
+    expected = normalize(rowwise(df.copy(), settings))
+    result = normalize(columnwise(df.copy(), settings))
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize('filename', RAW_FILES, ids=os.path.basename)
+def test_raw_file(filename):
+    company = os.path.basename(filename).split('_')[0]
+    assert_same(prepare(read_raw(filename), company), make_settings({'settings': PL_SETTINGS}))
+
+
+def test_every_flag():
+    settings = make_settings({'settings': FLAG_SETTINGS})
+    df = flag_frame()
+    assert set(df['company']) >= set(c for key in settings for c in settings[key])
+    assert_same(df, settings)
+
+
+def test_raw_files_bundled():
+    assert RAW_FILES
+
+
+@pytest.mark.parametrize('address', ['ul. Długa 5, Kraków, Polska', 'ul. Długa 12, Kraków',
+                                     'ul. Długa 13, Nowa Huta, Kraków, PL'])
+def test_named_rule_matches_parser(address):
+    rule = NAMED_RULES['address_location_country_comma']
+    assert rule(address) == fixers.parse_address_location_country_comma(address)
+    applied = rule.apply(pd.Series([address]))
+    assert {c: values[0] for c, values in applied.items()} == rule(address)
+
+
+def test_named_rule_leaves_single_part_alone():
+    # The parser raised IndexError here
+    rule = NAMED_RULES['address_location_country_comma']
+    assert rule('ul. Długa 8') == {}
+    assert all(values.empty for values in rule.apply(pd.Series(['ul. Długa 8'])).values())
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from eurosfordoctors import export
+
+
+def entities(uids):
+    return pd.DataFrame({
+        'uid': uids,
+        'name': 'Jan Kowalski',
+        'location': 'Warszawa',
+        'address': 'ul. Długa 5',
+        'postcode': '00-950',
+        'first_name': 'Jan',
+        'last_name': 'Kowalski',
+        'origin': 'PL',
+    }, dtype=object)
+
+
+def run(uids, previous=None):
+    df = export.make_slugs(entities(uids), previous=previous)
+    return dict(zip(df['uid'], df['slug'])), export.previous_slugs(df)
+
+
+def test_identical_entities_keep_their_slugs():
+    first, previous = run(['a', 'b'])
+    assert first == {'a': 'Jan-Kowalski-Warszawa-pl', 'b': 'Jan-Kowalski-Warszawa-pl-1'}
+    for _ in range(3):
+        slugs, previous = run(['b', 'a'], previous=previous)
+        assert slugs == first
+
+
+def test_new_entity_gets_next_suffix():
+    first, previous = run(['b'])
+    slugs, _ = run(['a', 'b'], previous=previous)
+    assert slugs == {'b': first['b'], 'a': 'Jan-Kowalski-Warszawa-pl-1'}
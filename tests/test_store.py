@@ -0,0 +1,45 @@
+import sqlite3
+
+from eurosfordoctors.store import SCHEMA, EntityStore
+
+
+def entity(uid, name, amount):
+    return {
+        'uid': uid,
+        'name': name,
+        'location': 'Warszawa',
+        'type': 'hcp',
+        'payments': [{'company': 'bayer', 'currency': 'PLN', 'type': 'fee', 'year': 2015, 'amount': amount}],
+    }
+
+
+def test_unchanged_entities_are_not_rewritten(tmp_path):
+    store = EntityStore(str(tmp_path / 'entities.db'))
+    assert store.upsert([entity('a', 'Jan Kowalski', 100.0), entity('b', 'Anna Nowak', 200.0)]) == 2
+    assert store.changed == 2
+    before = store.conn.total_changes
+    assert store.upsert([entity('a', 'Jan Kowalski', 100.0), entity('b', 'Anna Nowak', 200.0)]) == 2
+    assert store.changed == 0
+    assert store.conn.total_changes == before
+    payments = store.conn.execute('SELECT rowid FROM payments ORDER BY rowid').fetchall()
+
+    store.upsert([entity('a', 'Jan Kowalski', 100.0), entity('b', 'Anna Nowak-Kowalska', 250.0)])
+    assert store.changed == 1
+    assert store.get('b')['amount'] == 250.0
+    assert [e['uid'] for e in store.search('Kowalska')] == ['b']
+    assert store.conn.execute('SELECT rowid FROM payments ORDER BY rowid').fetchall()[0] == payments[0]
+    assert store.conn.execute('SELECT COUNT(*) FROM payments').fetchone()[0] == 2
+    store.close()
+
+
+def test_migrates_stores_without_hash(tmp_path):
+    path = str(tmp_path / 'entities.db')
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.execute('PRAGMA user_version = 1')
+    conn.close()
+    store = EntityStore(path)
+    store.upsert([entity('a', 'Jan Kowalski', 100.0)])
+    store.upsert([entity('a', 'Jan Kowalski', 100.0)])
+    assert store.changed == 0
+    store.close()